@@ -1,4 +1,15 @@
+import os
+
 from shapely.geometry import box, Point, LineString
+from shapely.wkt import loads
+
+# Crops of the latest and previous NJ extracts, written by
+# generate-changes and read by the tile scripts
+NJ_LATEST_SMALL = '/army/new-jersey-latest-small.osm'
+NJ_OLD_SMALL = '/army/new-jersey-old-small.osm'
+
+# Where the nodes of each crop are cached, see nodestore.cache_path
+NODE_CACHE = '/army/node-cache'
 
 def osm_func(etype, node, way, relation):
     if etype == "node":
@@ -34,9 +45,22 @@ def get_bbox_shape(bbox):
     if bbox[0] == bbox[2] and bbox[1] == bbox[3]:
         return Point(bbox[0], bbox[1])
     # check if just width xor height is missing
-    elif bbox[0] == bbox[2]:
-        return LineString([(bbox[1], bbox[3])])
-    elif bbox[1] == bbox[3]:
-        return LineString([(bbox[0], bbox[2])])
+    elif bbox[0] == bbox[2] or bbox[1] == bbox[3]:
+        return LineString([(bbox[0], bbox[1]), (bbox[2], bbox[3])])
     else:
         return box(*bbox)
+
+
+def get_shape_from_file(filename):
+    with open(filename) as f:
+        shape = loads(f.read().strip('\n'))
+        return shape
+
+
+def get_rutgers():
+    fileroot = os.path.join(os.path.dirname(__file__), "wkt")
+    campuses = [os.path.join(fileroot, path) for path in os.listdir(fileroot)]
+    return filter(
+        lambda x: x is not None,
+        [get_shape_from_file(campus) for campus in campuses]
+    )
@@ -1,7 +1,14 @@
+import argparse
+import os
 import os.path
-import shutil
+import shlex
 import subprocess
 import sys
+import tempfile
+
+from rutgers_osm import changeindex, dirty_tiles
+from rutgers_osm.models import CREATE, MODIFY, DELETE, iterparse_elements
+from rutgers_osm.xmlwriter import XMLWriter
 
 LOCKDIR = "/var/lock/maps"
 LOCK = os.path.join(LOCKDIR, "apply-changes")
@@ -9,49 +16,195 @@ LOCK = os.path.join(LOCKDIR, "apply-changes")
 CHANGES ="/army/changes"
 
 DTILES = "/army/dirty-tiles"
-DTILES_SINGLE = DTILES + "-{0}"
+
+OSM2PGSQL = "osm2pgsql --append --slim -d gis -C 1600 --number-processes 3 -e0-18"
+
+# Order elements are written in within a merged create or modify, a
+# delete goes the other way round
+ELEMENT_ORDER = {"node": 0, "way": 1, "relation": 2}
+
+
+def change_order(path):
+    """Sort key putting change files in the order generate-changes
+    numbered them"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return (0, int(name), name)
+    except ValueError:
+        return (1, 0, name)
+
+
+def pending_changes(directory):
+    return sorted([os.path.join(directory, path) for path in os.listdir(directory)
+                   if path.endswith('.osc')], key=change_order)
+
+
+def edit_rank(element, seq):
+    """Sort key for the edits of one element, oldest first: by version,
+    then timestamp, then seq, the order they were read in. File numbers
+    get reused, so they don't say which edit is newer."""
+    version = element.attrib.get('version')
+    return (int(version) if version else 0, element.attrib.get('timestamp', ''), seq)
+
+
+def merge_changes(changes, f):
+    """Write the combined effect of the osmChange files changes to f.
+    Only the newest edit of each element is kept (see edit_rank), and an
+    element whose oldest edit creates it and newest deletes it is left
+    out altogether.
+    """
+    # (tag, id) -> [oldest rank, its change type, newest rank, its change type, element]
+    state = {}
+    order = []
+    seq = 0
+    for change in changes:
+        for change_t, element in iterparse_elements(change):
+            key = (element.tag, element.attrib['id'])
+            rank = edit_rank(element, seq)
+            seq += 1
+            if key not in state:
+                state[key] = [rank, change_t, rank, change_t, element]
+                order.append(key)
+                continue
+            edits = state[key]
+            if rank < edits[0]:
+                edits[0:2] = [rank, change_t]
+            if rank > edits[2]:
+                edits[2:5] = [rank, change_t, element]
+
+    sections = {CREATE: [], MODIFY: [], DELETE: []}
+    for key in order:
+        first_rank, first_t, last_rank, change_t, element = state[key]
+        # Whether it existed before the first change
+        existed = first_t != CREATE
+        if change_t == DELETE:
+            if existed:
+                sections[DELETE].append(element)
+        else:
+            sections[MODIFY if existed else CREATE].append(element)
+
+    writer = XMLWriter(f)
+    writer.start('osmChange', version='0.6')
+    for change_t in (CREATE, MODIFY, DELETE):
+        direction = -1 if change_t == DELETE else 1
+        elements = sorted(sections[change_t], key=lambda e: direction * ELEMENT_ORDER[e.tag])
+        if not elements:
+            writer.element(change_t)
+            continue
+        writer.start(change_t)
+        for element in elements:
+            writer.write_element(element)
+        writer.end(change_t)
+    writer.end('osmChange')
+
+
+def osm2pgsql_command(command, expire_file, change):
+    """command, an osm2pgsql command line, set up to apply change and
+    write the tiles it expires to expire_file"""
+    return shlex.split(command) + ["-o", expire_file, change]
+
+
+def apply_change(command, change, expire_file):
+    """Run osm2pgsql for one change file, True if it succeeded"""
+    print "Applying: {0}".format(change)
+    try:
+        process = subprocess.Popen(osm2pgsql_command(command, expire_file, change))
+    except OSError as e:
+        print "Failed to apply {0}: {1}".format(change, e)
+        return False
+    try:
+        returncode = process.wait()
+    except KeyboardInterrupt:
+        # osm2pgsql got the ctrl-c too, hold on to the lock until it's
+        # actually stopped
+        process.wait()
+        raise
+    if returncode != 0:
+        print "Failed to apply {0}: osm2pgsql exited with {1}".format(change, returncode)
+        return False
+    return True
+
+
+def apply_merged(command, changes, expire_file):
+    """Merge changes into one file and apply it in a single osm2pgsql
+    run. Returns the changes applied, all of them or none."""
+    fd, merged = tempfile.mkstemp(suffix='.osc')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            merge_changes(changes, f)
+        print "Merged {0} changes into {1}".format(len(changes), merged)
+        if not apply_change(command, merged, expire_file):
+            return []
+    finally:
+        os.remove(merged)
+    return changes
+
 
 def apply_changes_main():
-    if os.path.isfile(LOCK):
-        print "Someone's already applying changes! Check {0}".format(LOCK)
+    parser = argparse.ArgumentParser(
+        description='Apply pending change files to the database with osm2pgsql')
+    parser.add_argument('-c', '--changes',
+                        default=CHANGES,
+                        help='Changes directory')
+    parser.add_argument('-d', '--dirty-tiles',
+                        default=DTILES,
+                        help='Where to write the tiles the changes expire')
+    parser.add_argument('-l', '--lock',
+                        default=LOCK,
+                        help='Lock file')
+    parser.add_argument('-C', '--osm2pgsql',
+                        default=OSM2PGSQL,
+                        help='osm2pgsql command line, the expire file and '
+                             'change file are appended')
+    parser.add_argument('-M', '--merge',
+                        action='store_true',
+                        help='Merge all pending changes and apply them in '
+                             'a single osm2pgsql run')
+    parser.add_argument('-x', '--change-index',
+                        default=changeindex.CHANGE_INDEX,
+                        help='Database of the elements each change file touches')
+    args = parser.parse_args()
+
+    if os.path.isfile(args.lock):
+        print "Someone's already applying changes! Check {0}".format(args.lock)
         sys.exit(1)
 
-    with open(LOCK, 'w+') as lock:
+    with open(args.lock, 'w+') as lock:
         lock.write(str(os.getpid()))
 
-    if os.path.isfile(DTILES):
-        os.remove(DTILES)
-
-    for change in [os.path.join(CHANGES, change_path) for change_path in os.listdir(CHANGES)]:
-        print "Applying: {0}".format(change)
-        changename = os.path.splitext(os.path.basename(change))[0]
-        d_t_location = DTILES_SINGLE.format(changename)
-        osm2pgsql_cmd = [
-            "osm2pgsql",
-            "--append",
-            "--slim",
-            "-d",
-            "gis",
-            "-C",
-            "1600",
-            "--number-processes",
-            "3",
-            "-e0-18",
-            "-o",
-            d_t_location
-        ]
-
-        try:
-            subprocess.check_call(osm2pgsql_cmd)
-        except:
-            continue
+    index = None
+    try:
+        index = changeindex.ChangeIndex(args.change_index)
+        if os.path.isfile(args.dirty_tiles):
+            os.remove(args.dirty_tiles)
 
-        if not os.path.isfile(DTILES):
-            shutil.move(d_t_location, DTILES)
+        changes = pending_changes(args.changes)
+        expired = []
+        if args.merge and changes:
+            d_t_location = args.dirty_tiles + "-merged"
+            applied = apply_merged(args.osm2pgsql, changes, d_t_location)
+            if applied:
+                expired.append(d_t_location)
+            for change in applied:
+                os.remove(change)
+                index.applied(change)
         else:
-            with open(DTILES, 'a') as dt:
-                with open(d_t_location) as dtl:
-                    dt.write(dtl.read())
-                os.remove(dtl)
-        os.remove(change)
-    os.remove(LOCK)
+            for change in changes:
+                changename = os.path.splitext(os.path.basename(change))[0]
+                d_t_location = args.dirty_tiles + "-{0}".format(changename)
+                if apply_change(args.osm2pgsql, change, d_t_location):
+                    expired.append(d_t_location)
+                    os.remove(change)
+                    index.applied(change)
+
+        # One sorted list with every tile once, however many changes touched it
+        dirty = dirty_tiles.dirty_set(dirty_tiles.read_tiles(expired))
+        with open(args.dirty_tiles, 'w') as dt:
+            dirty_tiles.write_tiles(dt, dirty_tiles.sorted_tiles(dirty))
+        for d_t_location in expired:
+            if os.path.isfile(d_t_location):
+                os.remove(d_t_location)
+    finally:
+        if index is not None:
+            index.close()
+        os.remove(args.lock)
@@ -0,0 +1,157 @@
+import os.path
+import sqlite3
+import time
+
+from rutgers_osm.models import iterparse_elements
+
+CHANGE_INDEX = '/army/changes.sqlite'
+
+# Where a change file is in its life
+PENDING = 'pending'
+CHANGES = 'changes'
+APPLIED = 'applied'
+
+# Files not yet applied to the database
+QUEUED = (PENDING, CHANGES)
+
+
+def element_bounds(change):
+    """Bounds of every element of an OSMChange by (tag, id), for add()"""
+    return dict(((element.TAG, element.osm_id), element.bounds())
+                for element in change.create + change.modify + change.delete)
+
+
+class ChangeIndex(object):
+    """Which elements every change file touches and where, kept in
+    sqlite so finding the queued changes in an area, or the ones that
+    edit the same elements as a new change, is a query rather than a
+    parse of every file. Bounds go in an R-tree table when sqlite has
+    the module, and in an ordinary indexed table otherwise.
+
+    File names get reused once a change is applied, so a file is known
+    by its row id and applied files are kept as history.
+    """
+
+    def __init__(self, path=CHANGE_INDEX):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "id INTEGER PRIMARY KEY, path TEXT, state TEXT, "
+                        "created REAL, applied REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_path ON files (path, state)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS elements ("
+                        "id INTEGER PRIMARY KEY, file INTEGER, action TEXT, "
+                        "tag TEXT, osm_id TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS elements_file ON elements (file)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS elements_osm_id ON elements (osm_id, tag)")
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS bounds "
+                            "USING rtree(id, minx, maxx, miny, maxy)")
+            self.rtree = True
+        except sqlite3.OperationalError:
+            self.db.execute("CREATE TABLE IF NOT EXISTS bounds ("
+                            "id INTEGER PRIMARY KEY, minx REAL, maxx REAL, "
+                            "miny REAL, maxy REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS bounds_x ON bounds (minx, maxx)")
+            self.rtree = False
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def file_id(self, path, states=QUEUED):
+        row = self.db.execute(
+            "SELECT id FROM files WHERE path = ? AND state IN ({0}) "
+            "ORDER BY id DESC".format(','.join('?' * len(states))),
+            [os.path.abspath(path)] + list(states)).fetchone()
+        return row[0] if row else None
+
+    def forget(self, file_id):
+        self.db.execute("DELETE FROM bounds WHERE id IN "
+                        "(SELECT id FROM elements WHERE file = ?)", (file_id,))
+        self.db.execute("DELETE FROM elements WHERE file = ?", (file_id,))
+        self.db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def add(self, path, state=PENDING, bounds=None):
+        """Record every element of the osmChange file at path, replacing
+        anything queued under path before. Nodes are placed by their own
+        coordinates, other elements by bounds, a dict of (tag, id) to
+        (minx, miny, maxx, maxy) (see element_bounds). Elements that
+        can't be placed are still recorded, touching() just won't find
+        them."""
+        bounds = bounds or {}
+        old = self.file_id(path)
+        if old is not None:
+            self.forget(old)
+
+        cursor = self.db.execute(
+            "INSERT INTO files (path, state, created) VALUES (?, ?, ?)",
+            (os.path.abspath(path), state, time.time()))
+        file_id = cursor.lastrowid
+        for action, element in iterparse_elements(path):
+            key = (element.tag, element.attrib['id'])
+            cursor = self.db.execute(
+                "INSERT INTO elements (file, action, tag, osm_id) VALUES (?, ?, ?, ?)",
+                (file_id, action, element.tag, element.attrib['id']))
+            if element.tag == "node" and 'lon' in element.attrib and 'lat' in element.attrib:
+                lon, lat = float(element.attrib['lon']), float(element.attrib['lat'])
+                box = (lon, lat, lon, lat)
+            else:
+                box = bounds.get(key)
+            if box is None:
+                continue
+            minx, miny, maxx, maxy = box
+            self.db.execute(
+                "INSERT INTO bounds (id, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)",
+                (cursor.lastrowid, minx, maxx, miny, maxy))
+        self.db.commit()
+        return file_id
+
+    def move(self, path, new_path, state=CHANGES):
+        """A queued change file was moved to new_path, e.g. committed
+        from pending to changes"""
+        self.db.execute("UPDATE files SET path = ?, state = ? WHERE id = ?",
+                        (os.path.abspath(new_path), state, self.file_id(path)))
+        self.db.commit()
+
+    def applied(self, path):
+        """A queued change file was applied to the database and removed"""
+        self.db.execute("UPDATE files SET state = ?, applied = ? WHERE id = ?",
+                        (APPLIED, time.time(), self.file_id(path)))
+        self.db.commit()
+
+    def touching(self, bbox, states=QUEUED):
+        """(path, action, tag, osm_id) for every element of a file in one
+        of states whose bounds overlap bbox (minx, miny, maxx, maxy)"""
+        minx, miny, maxx, maxy = bbox
+        return self.db.execute(
+            "SELECT files.path, elements.action, elements.tag, elements.osm_id "
+            "FROM bounds JOIN elements ON elements.id = bounds.id "
+            "JOIN files ON files.id = elements.file "
+            "WHERE bounds.minx <= ? AND bounds.maxx >= ? "
+            "AND bounds.miny <= ? AND bounds.maxy >= ? "
+            "AND files.state IN ({0}) ORDER BY files.id".format(','.join('?' * len(states))),
+            [maxx, minx, maxy, miny] + list(states)).fetchall()
+
+    def files_touching(self, bbox, states=QUEUED):
+        """Paths of the files in states with anything inside bbox"""
+        paths = []
+        for path, action, tag, osm_id in self.touching(bbox, states):
+            if path not in paths:
+                paths.append(path)
+        return paths
+
+    def conflicts(self, change, states=(PENDING,)):
+        """Queued files that edit the same elements as OSMChange change,
+        as a dict of path to [(tag, osm_id)]"""
+        found = {}
+        for element in change.create + change.modify + change.delete:
+            rows = self.db.execute(
+                "SELECT DISTINCT files.path FROM elements "
+                "JOIN files ON files.id = elements.file "
+                "WHERE elements.osm_id = ? AND elements.tag = ? "
+                "AND files.state IN ({0})".format(','.join('?' * len(states))),
+                [element.osm_id, element.TAG] + list(states))
+            for path, in rows:
+                found.setdefault(path, []).append((element.TAG, element.osm_id))
+        return found
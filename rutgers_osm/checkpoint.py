@@ -0,0 +1,44 @@
+import os.path
+
+
+class Checkpoint(object):
+    """Work units finished so far, appended to filename one "z x0 x1"
+    line at a time as they complete, so a run that dies can be restarted
+    and pick up where it left off.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = set()
+        if os.path.isfile(filename):
+            with open(filename, 'r+') as f:
+                lines = f.read().split('\n')
+                # Drop a line cut short by a crash, that unit is redone
+                if lines[-1]:
+                    f.truncate(f.tell() - len(lines[-1]))
+                for line in lines[:-1]:
+                    self.done.add(tuple(int(part) for part in line.split()))
+        self.f = open(filename, 'a')
+
+    def __contains__(self, unit):
+        return unit in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, unit):
+        self.done.add(unit)
+        self.f.write("{0} {1} {2}\n".format(*unit))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def in_shard(index, shard=None):
+    """Whether work unit number index belongs to shard (i, n), the i-th
+    of n machines splitting a run between them"""
+    if shard is None:
+        return True
+    i, n = shard
+    return index % n == i
@@ -2,25 +2,37 @@ import argparse
 import os
 import shutil
 
+from rutgers_osm import changeindex
+from rutgers_osm.generate_changes import lowest_avail_filename
+
 PREFIX = '/army'
 PENDING = os.path.join(PREFIX, 'pending')
 CHANGES = os.path.join(PREFIX, 'changes')
 
 
 def commit_changes():
-    parser = argparse.ArgumentParser(description='')
+    parser = argparse.ArgumentParser(description='Move pending change files over to be applied')
     parser.add_argument('--all', action='store_true')
+    parser.add_argument('-x', '--change-index',
+                        default=changeindex.CHANGE_INDEX,
+                        help='Database of the elements each change file touches')
     parser.add_argument('ids', metavar='IDs', type=int, nargs='*')
     args = parser.parse_args()
 
-    paths = os.listdir(PENDING) if args.all else '{0}.osc'.format(args.ids)
+    paths = os.listdir(PENDING) if args.all else ['{0}.osc'.format(i) for i in args.ids]
 
+    index = changeindex.ChangeIndex(args.change_index)
     for path in paths:
-        pending = os.path.join(path, PENDING)
+        pending = os.path.join(PENDING, path)
+        # Change numbers are per directory, so take the next free one
+        change = lowest_avail_filename(CHANGES)
         try:
-            shutil.move(pending, CHANGES)
-        except IOError as e:
+            shutil.move(pending, change)
+        except (IOError, OSError, shutil.Error) as e:
             print "Error: {0}".format(pending)
             print e
+            continue
+        index.move(pending, change, changeindex.CHANGES)
+    index.close()
 
     print "Done!"
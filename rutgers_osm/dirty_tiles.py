@@ -0,0 +1,175 @@
+import os.path
+
+from shapely.geometry import box
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from rutgers_osm.models import DELETE, MODIFY, OSM, OSMChange, iterparse_elements
+from rutgers_osm.tiles import GoogleProjection, iter_tiles, tile_key
+
+# What prioritized() puts first: low zooms, or tiles on campus
+PRIORITIES = ('zoom', 'campus')
+
+
+def parse_tiles(lines):
+    """Yield (z, x, y) from lines of z/x/y, as written by osm2pgsql -o"""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        z, x, y = [int(dim) for dim in line.split('/')]
+        yield (z, x, y)
+
+
+def read_tiles(paths):
+    """Yield (z, x, y) from every dirty tile file in paths that exists"""
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        with open(path) as f:
+            for tile in parse_tiles(f):
+                yield tile
+
+
+def write_tiles(f, tiles):
+    for z, x, y in tiles:
+        f.write("{0}/{1}/{2}\n".format(z, x, y))
+
+
+def children(tile, max_zoom):
+    """Yield tile and every tile under it down to max_zoom"""
+    z, x, y = tile
+    for cz in range(z, max_zoom + 1):
+        size = 1 << (cz - z)
+        for cx in range(x * size, (x + 1) * size):
+            for cy in range(y * size, (y + 1) * size):
+                yield (cz, cx, cy)
+
+
+def parents(tile, min_zoom):
+    """Yield tile and every tile above it up to min_zoom"""
+    z, x, y = tile
+    while z >= min_zoom:
+        yield (z, x, y)
+        z, x, y = z - 1, x // 2, y // 2
+
+
+def dirty_set(tiles, min_zoom=None, max_zoom=None, expand_children=False,
+              expand_parents=False):
+    """Collect tiles into a set, dropping duplicates and anything outside
+    min_zoom..max_zoom. With expand_children the tiles at the deepest
+    zoom listed also dirty the tiles under them down to max_zoom, with
+    expand_parents every tile dirties the tiles above it up to min_zoom.
+
+    osm2pgsql lists every zoom of its expiry range, so the tiles under
+    any shallower tile are listed already. Expanding those too would
+    turn one z0 tile into every tile in the world.
+    """
+    if expand_children and max_zoom is None:
+        raise ValueError("expand_children needs a max_zoom")
+    low = 0 if min_zoom is None else min_zoom
+
+    listed = set(tiles)
+    dirty = set(listed)
+    if expand_children and listed:
+        deepest = max(z for z, x, y in listed)
+        for tile in listed:
+            if tile[0] == deepest:
+                dirty.update(children(tile, max_zoom))
+    if expand_parents:
+        for tile in listed:
+            dirty.update(parents(tile, low))
+
+    return set(tile for tile in dirty
+               if tile[0] >= low and (max_zoom is None or tile[0] <= max_zoom))
+
+
+def sorted_tiles(tiles, order='hilbert', metatile=1):
+    """Dirty tiles in rendering order, zoom by zoom along order with the
+    tiles of each metatile next to each other"""
+    return sorted(tiles, key=tile_key(order, metatile))
+
+
+def prioritized(tiles, order='xy', metatile=1, shape=None, first='zoom'):
+    """Dirty tiles with the ones that matter most first. Lower zooms come
+    before higher ones and, when shape is given, metatiles touching it
+    before the rest. With first='campus' every campus tile comes before
+    any other, whatever its zoom.
+    """
+    if first not in PRIORITIES:
+        raise ValueError("Unknown priority {0}".format(first))
+    key = tile_key(order, metatile)
+    if shape is None:
+        return sorted(tiles, key=key)
+
+    shape = prep(shape)
+    proj = GoogleProjection(max(z for z, x, y in tiles) + 1) if tiles else None
+
+    # Decided per metatile so its tiles stay together, with the bounds
+    # of a whole row of metatiles worked out at once
+    rows = {}
+    for z, x, y in tiles:
+        rows.setdefault((z, y // metatile), set()).add(x // metatile)
+    inside = set()
+    for (z, my), mxs in rows.iteritems():
+        lo = min(mxs)
+        row = proj.tile_row_bounds(my * metatile, lo * metatile, max(mxs) * metatile, z, metatile)
+        for mx in mxs:
+            if shape.intersects(box(*row[mx - lo])):
+                inside.add((z, mx, my))
+
+    def on_campus(z, x, y):
+        return (z, x // metatile, y // metatile) in inside
+
+    if first == 'campus':
+        return sorted(tiles, key=lambda tile: (not on_campus(*tile), key(tile)))
+    return sorted(tiles, key=lambda tile: (tile[0], not on_campus(*tile), key(tile)))
+
+
+def change_geometry(change, old=None):
+    """Everything an OSMChange touches, as one shapely geometry in
+    lon/lat: the new geometry of every element, plus given old, an OSM of
+    the previous versions of the elements it modifies or deletes, their
+    old geometry. None if there is nothing to draw.
+    """
+    elements = change.create + change.modify + change.delete
+    if old is not None:
+        elements = elements + old.elements
+    if not elements:
+        return None
+    return unary_union([element.geometry() for element in elements])
+
+
+def change_tiles(change, min_zoom, max_zoom, old=None):
+    """Set of (z, x, y) tiles from min_zoom to max_zoom touched by the
+    geometry of change, see change_geometry."""
+    shape = change_geometry(change, old)
+    if shape is None:
+        return set()
+    # The quadtree walk skips empty stretches between far apart edits
+    return set(iter_tiles(min_zoom, max_zoom, shape=shape, order='zorder'))
+
+
+def change_file_tiles(sources, min_zoom, max_zoom, latest, old, node_caches=None):
+    """change_tiles for osmChange files sources together, with their
+    nodes looked up in the latest crop and then the old one, and
+    previous geometries taken from the old crop. The old crop is read
+    once for all of them, and given node_caches, the cache file of each
+    crop, node lookups come from the cache (see OSMChange.from_file).
+    """
+    # Deletes often carry no nodes or coordinates, so the ids to look up
+    # come straight from the files. Their old geometry is all there is to
+    # draw, OSMChange leaves them out itself.
+    touched = set((element.tag, element.attrib['id'])
+                  for source in sources
+                  for change_t, element in iterparse_elements(source)
+                  if change_t in (MODIFY, DELETE))
+    # A tile touches the union of the geometries if it touches any one
+    # of them, so the changes can be drawn as one
+    change = OSMChange([], [], [])
+    for source in sources:
+        parsed = OSMChange.from_file(source, latest, old, node_caches=node_caches)
+        change.create.extend(parsed.create)
+        change.modify.extend(parsed.modify)
+        change.delete.extend(parsed.delete)
+    return change_tiles(change, min_zoom, max_zoom, OSM.from_file(old, touched))
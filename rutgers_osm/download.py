@@ -0,0 +1,124 @@
+import json
+import os
+import os.path
+import re
+import urllib2
+
+# Bytes read from the connection at a time
+CHUNK_SIZE = 1024 * 1024
+
+PARTIAL = "{0}.part"
+META = "{0}.meta"
+
+
+def read_meta(filename):
+    """Validators (etag, last_modified) saved alongside filename"""
+    try:
+        with open(META.format(filename)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_meta(filename, meta):
+    with open(META.format(filename), 'w') as f:
+        json.dump(meta, f)
+
+
+def remove_partial(partial):
+    for path in [partial, META.format(partial)]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def expected_size(response):
+    """Full size of the resource from Content-Range or Content-Length"""
+    info = response.info()
+    content_range = info.getheader('Content-Range')
+    if content_range:
+        match = re.search(r'/(\d+)$', content_range)
+        return int(match.group(1)) if match else None
+    length = info.getheader('Content-Length')
+    return int(length) if length else None
+
+
+def fetch(url, outfile, chunk_size=CHUNK_SIZE):
+    """Stream url to a partial file next to outfile, chunk_size bytes at
+    a time. A partial file left by an interrupted run is resumed with a
+    Range request, and nothing is downloaded if the server reports that
+    outfile is still current. Returns the path of the completed download,
+    or None if outfile is unchanged.
+    """
+    partial = PARTIAL.format(outfile)
+
+    while True:
+        request = urllib2.Request(url)
+
+        current = read_meta(outfile) if os.path.isfile(outfile) else {}
+        if current.get('etag'):
+            request.add_header('If-None-Match', current['etag'])
+        if current.get('last_modified'):
+            request.add_header('If-Modified-Since', current['last_modified'])
+
+        resume = read_meta(partial)
+        offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+        validator = resume.get('etag') or resume.get('last_modified')
+        if offset and validator:
+            request.add_header('Range', 'bytes={0}-'.format(offset))
+            request.add_header('If-Range', validator)
+
+        try:
+            response = urllib2.urlopen(request)
+            break
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return None
+            if e.code == 416 and offset:
+                if expected_size(e) == offset:
+                    # Finished before the last run was cut short
+                    return partial
+                # The partial file doesn't fit the resource, start over
+                remove_partial(partial)
+                continue
+            raise
+
+    if response.getcode() == 206:
+        mode = 'ab'
+    else:
+        mode = 'wb'
+        write_meta(partial, {
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified')
+        })
+
+    with open(partial, mode) as f:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+    response.close()
+
+    size = expected_size(response)
+    if size is not None and os.path.getsize(partial) != size:
+        raise IOError("Incomplete download of {0}: got {1} of {2} bytes".format(
+            url, os.path.getsize(partial), size))
+
+    return partial
+
+
+def install(partial, outfile):
+    """Move a completed download and its validators over outfile"""
+    os.rename(partial, outfile)
+    os.rename(META.format(partial), META.format(outfile))
+
+
+def download(url, outfile, chunk_size=CHUNK_SIZE):
+    """Download url to outfile unless it is unchanged. Returns True if
+    outfile was replaced.
+    """
+    partial = fetch(url, outfile, chunk_size)
+    if partial is None:
+        return False
+    install(partial, outfile)
+    return True
@@ -5,9 +5,7 @@ import os.path
 import shutil
 import smtplib
 import subprocess
-import urllib2
-import xml.etree.ElementTree as ET
-import xml.dom.minidom as MD
+import sys
 from email import Encoders
 from email.MIMEBase import MIMEBase
 from email.MIMEMultipart import MIMEMultipart
@@ -16,12 +14,13 @@ from email.Utils import formatdate
 
 import argparse
 
-from rutgers_osm.models import OSMChange, max_bbox
+from rutgers_osm.models import OSMChange, max_bbox, get_bbox_shape, write_change_without
+from rutgers_osm.nodeindex import NodeIndex
+from rutgers_osm.nodestore import cache_path, prune_cache
 import rutgers_osm.osmosis as osmosis
+from rutgers_osm import NJ_LATEST_SMALL, NJ_OLD_SMALL, NODE_CACHE, changeindex, download, get_rutgers
 
-import rutgers_osm
-
-from shapely.wkt import loads
+from shapely.prepared import prep
 
 # URL for latest NJ pbf
 NJ_LATEST = ("http://download.geofabrik.de/"
@@ -29,9 +28,7 @@ NJ_LATEST = ("http://download.geofabrik.de/"
 
 # Disk locations for latest and previous NJ pbf
 NJ_LATEST_PBF = '/army/new-jersey-latest.osm.pbf'
-NJ_LATEST_SMALL = '/army/new-jersey-latest-small.osm'
 NJ_OLD_PBF = '/army/new-jersey-old.osm.pbf'
-NJ_OLD_SMALL = '/army/new-jersey-old-small.osm'
 
 # Diff and changes disk locations
 DIFF = '/army/diff.osc'
@@ -41,11 +38,6 @@ PENDING = '/army/pending'
 TMPFILE = '/tmp/map_scripts_tmp.osm'
 
 
-def pretty_ET(root):
-    """Pretty print xml from ElementTree"""
-    return MD.parseString(ET.tostring(root)).toprettyxml()
-
-
 def send_mail(changes, address):
     """Send email requesting maps approval."""
     msg = MIMEMultipart()
@@ -68,12 +60,6 @@ def send_mail(changes, address):
     smtp.close()
 
 
-def get_new_jersey(outfile, nj_latest):
-    """Download latest version of New Jersey from geofabrik"""
-    with open(outfile, 'w') as f:
-        f.write(urllib2.urlopen(nj_latest).read())
-
-
 def lowest_avail_id(directory):
     current_ids = set(
         [int(os.path.splitext(f)[0]) for f in os.listdir(directory)])
@@ -89,28 +75,29 @@ def lowest_avail_filename(directory):
     return os.path.join(directory, str(lowest_avail_id(directory)) + '.osc')
 
 
-def get_shape_from_file(filename):
-    with open(filename) as f:
-        shape = loads(f.read().strip('\n'))
-        return shape
-
-
-def get_rutgers():
-    fileroot = os.path.join(os.path.dirname(rutgers_osm.__file__), "wkt")
-    campuses = [os.path.join(fileroot, path) for path in os.listdir(fileroot)]
-    return filter(
-        lambda x: x is not None,
-        [get_shape_from_file(campus) for campus in campuses]
-    )
-
-
 def intersects_any(bbox, rutgers):
     for campus in rutgers:
-        if bbox.intersects(campus):
+        if campus.intersects(bbox):
             return True
     return False
 
 
+def intersecting(elements, rutgers, rutgers_bbox):
+    """Filter elements down to the ones touching a campus. All the bounds
+    are checked against the combined campus envelope first, so only the
+    survivors get a shapely geometry built and tested against the
+    (prepared) campus shapes.
+    """
+    minx, miny, maxx, maxy = rutgers_bbox
+    bounds = [element.bounds() for element in elements]
+    candidates = [
+        (element, b) for element, b in zip(elements, bounds)
+        if b[0] <= maxx and b[2] >= minx and b[1] <= maxy and b[3] >= miny
+    ]
+    return [element for element, b in candidates
+            if intersects_any(get_bbox_shape(b), rutgers)]
+
+
 def generate_changes_main():
     parser = argparse.ArgumentParser(
         description='Create change files based on a bounding box')
@@ -146,17 +133,38 @@ def generate_changes_main():
     parser.add_argument('-t', '--tmp-file',
                         default=TMPFILE,
                         help='Location of temp file')
+    parser.add_argument('-C', '--crop-only',
+                        action='store_true',
+                        help='Take the non-intersecting changes from the '
+                             'cropped diff instead of re-diffing the full '
+                             'pbfs with osmosis. Much faster, but changes '
+                             'outside the crop are not applied')
+    parser.add_argument('-N', '--node-cache',
+                        default=NODE_CACHE,
+                        help='Directory to cache the nodes of each crop in, '
+                             'so the old crop needn\'t be parsed again')
+    parser.add_argument('-I', '--node-index',
+                        help='Node index of the full latest extract, rebuilt '
+                             'alongside the crops, to look up nodes of ways '
+                             'that run off the crop')
+    parser.add_argument('-x', '--change-index',
+                        default=changeindex.CHANGE_INDEX,
+                        help='Database of the elements each change file touches')
     args = parser.parse_args()
 
     rutgers = get_rutgers()
     rutgers_bbox = reduce(max_bbox, [campus.bounds for campus in rutgers])
 
     if not args.short_circuit:
+        print "Getting new New Jersey file"
+        latest = download.fetch(args.nj_url, args.nj_latest)
+        if latest is None:
+            print "New Jersey is unchanged, nothing to do"
+            return
+
         print "Moving old New Jersey file"
         shutil.move(args.nj_latest, args.nj_old)
-
-        print "Getting new New Jersey file"
-        get_new_jersey(args.nj_latest, args.nj_url)
+        download.install(latest, args.nj_latest)
 
         latest_crop_cmd = osmosis.crop(args.nj_latest, rutgers_bbox, args.nj_latest_small)
         old_crop_cmd = osmosis.crop(args.nj_old, rutgers_bbox, args.nj_old_small)
@@ -166,53 +174,83 @@ def generate_changes_main():
         print latest_crop_cmd
         print old_crop_cmd
         print crop_diff_cmd
+
+        stages = [
+            osmosis.Stage("latest crop", latest_crop_cmd),
+            osmosis.Stage("old crop", old_crop_cmd),
+            osmosis.Stage("crop diff", crop_diff_cmd,
+                          depends=["latest crop", "old crop"])
+        ]
+        if args.node_index:
+            index_cmd = [sys.executable, '-m', 'rutgers_osm.nodeindex',
+                         args.nj_latest, args.node_index]
+            print index_cmd
+            stages.append(osmosis.Stage("node index", index_cmd))
         print ""
 
         print "Calling osmosis"
-        subprocess.check_call(latest_crop_cmd)
-        subprocess.check_call(old_crop_cmd)
-        subprocess.check_call(crop_diff_cmd)
+        osmosis.run_pipeline(stages)
 
     print "Parsing diff"
-    changes = OSMChange.from_xml(
-        ET.parse(args.diff),
-        ET.parse(args.nj_latest_small),
-        ET.parse(args.nj_old_small)
+    # Hashed once here, both parses and the pruning use them
+    node_caches = [cache_path(args.node_cache, crop)
+                   for crop in (args.nj_latest_small, args.nj_old_small)]
+    node_index = NodeIndex(args.node_index) if args.node_index else None
+    changes = OSMChange.from_file(
+        args.diff,
+        args.nj_latest_small,
+        args.nj_old_small,
+        node_caches=node_caches,
+        node_index=node_index
     )
-
-    ask_create = []
-    ask_modify = []
-    ask_delete = []
-
-    split_changes = [
-        (ask_create, changes.create),
-        (ask_modify, changes.modify),
-        (ask_delete, changes.delete)
-    ]
+    if node_index is not None:
+        node_index.close()
+    # Tonight's latest crop is tomorrow's old one, anything older is done with
+    prune_cache(args.node_cache, node_caches)
 
     print "Checking intersections"
-    for ask_change, change in split_changes:
-        for element in change:
-            if intersects_any(element.get_bbox(), rutgers):
-                ask_change.append(element)
+    campuses = [prep(campus) for campus in rutgers]
+    ask_changes = OSMChange(
+        intersecting(changes.create, campuses, rutgers_bbox),
+        intersecting(changes.modify, campuses, rutgers_bbox),
+        intersecting(changes.delete, campuses, rutgers_bbox)
+    )
 
-    ask_changes = OSMChange(ask_create, ask_modify, ask_delete)
+    index = changeindex.ChangeIndex(args.change_index)
+    for path, elements in index.conflicts(ask_changes).iteritems():
+        print "{0} also edits {1}".format(path, ", ".join(
+            "{0} {1}".format(tag, osm_id) for tag, osm_id in elements))
 
     print "Writing intersections to disk"
     pending_filename = lowest_avail_filename(args.pending)
     with open(pending_filename, 'w') as f:
-        f.write(pretty_ET(ask_changes.to_xml()).encode('utf-8'))
-
-    print "Getting non-intersecting changes"
-    apply_cmd = osmosis.apply_diff(args.nj_old, pending_filename, args.tmp_file)
-    subprocess.check_call(apply_cmd)
+        ask_changes.write(f)
 
-    print "Writing non-intersecting changes to disk"
     apply_filename = lowest_avail_filename(args.changes)
-    diff_cmd = osmosis.diff(args.tmp_file, args.nj_latest, apply_filename)
-    subprocess.check_call(diff_cmd)
-
-    os.remove(args.tmp_file)
+    if args.crop_only:
+        print "Writing non-intersecting changes to disk"
+        # Copied from the diff's xml, so anything the model couldn't
+        # resolve against the crops is still applied
+        with open(apply_filename, 'w') as f:
+            write_change_without(args.diff, ask_changes.element_ids(), f)
+    else:
+        print "Getting non-intersecting changes"
+        apply_cmd = osmosis.apply_diff(args.nj_old, pending_filename, args.tmp_file)
+        subprocess.check_call(apply_cmd)
+
+        print "Writing non-intersecting changes to disk"
+        diff_cmd = osmosis.diff(args.tmp_file, args.nj_latest, apply_filename)
+        subprocess.check_call(diff_cmd)
+
+        os.remove(args.tmp_file)
+
+    print "Indexing changes"
+    # Read back from the files as written, placed where the cropped
+    # diff could place them
+    bounds = changeindex.element_bounds(changes)
+    index.add(pending_filename, changeindex.PENDING, bounds)
+    index.add(apply_filename, changeindex.CHANGES, bounds)
+    index.close()
 
     if not args.no_send_mail:
         print "Sending mail"
@@ -1,10 +1,12 @@
+import sys
 import urllib2
 import xml.etree.ElementTree as ET
-import xml.dom.minidom
 import Polygon, Polygon.IO
 import argparse
 from scipy import spatial
 
+from rutgers_osm.xmlwriter import XMLWriter
+
 
 class Way():
     """Object representation of ways. Has all nodes and an
@@ -133,58 +135,56 @@ def make_relations(root, pair):
                     break
     return ret
 
-def generate_josm(pairs):
-    """Make josm from pairs of ways to be replaced
-    Returns the root node in an ElementTree
+def generate_josm(writer, pairs, largest_bound):
+    """Write josm for pairs of ways to be replaced
+    straight to an XMLWriter
     """
-    # Make root of output xml
-    josm_root = ET.Element('osm', {'version': "0.6", 'generator': "gen_josm"})
-    ET.SubElement(josm_root, 'bounds', {'minlat': largest_bound[0], 'minlon': largest_bound[1], 'maxlat': largest_bound[2], 'maxlon': largest_bound[3], 'origin': 'gen_josm'})
+    writer.start('osm', {'version': "0.6", 'generator': "gen_josm"})
+    writer.element('bounds', {'minlat': largest_bound[0], 'minlon': largest_bound[1], 'maxlat': largest_bound[2], 'maxlon': largest_bound[3], 'origin': 'gen_josm'})
 
     # Generate nodes then ways in output xml
     # place_id is a new id (JOSM specifies a negative id as a new entry
     # TODO regenerate relationships
     place_id = -1
     for pair in pairs:
-        nodes = []
+        node_ids = []
         for node in pair[0].nodes:
-            e_node = ET.SubElement(josm_root, 'node', node.attrib)
-            e_node.attrib['id'] = str(place_id)
-            nodes.append(e_node)
-            place_id -= 1
-            for tag in node.findall('tag'):
-                ET.SubElement(e_node, 'tag', tag.attrib)
-                e_node.attrib['id'] = str(place_id)
-                place_id -= 1
-        way = ET.SubElement(josm_root, 'way', pair[0].attrib)
-        way.attrib['id'] = str(place_id)
+            tags = node.findall('tag')
+            # every tag also takes an id, the node keeps the last one
+            node_id = str(place_id - len(tags))
+            place_id -= len(tags) + 1
+            node_ids.append(node_id)
+            if tags:
+                writer.start('node', node.attrib, id=node_id)
+                for tag in tags:
+                    writer.element('tag', tag.attrib)
+                writer.end('node')
+            else:
+                writer.element('node', node.attrib, id=node_id)
+        way_id = str(place_id)
         for relation in pair[2]:
             for member in relation.findall('member'):
                 if member.attrib['type'] == "way" and member.attrib['ref'] == pair[1].attrib['id']:
-                    member.attrib['ref'] = way.attrib['id']
+                    member.attrib['ref'] = way_id
         place_id -= 1
-        for nd in nodes:
-            ET.SubElement(way, 'nd', {'ref': nd.attrib['id']})
+        writer.start('way', pair[0].attrib, id=way_id)
+        for nd in node_ids:
+            writer.element('nd', {'ref': nd})
         for key in pair[0].tags:
-            ET.SubElement(way, 'tag', {'k': key, 'v': pair[0].tags[key]})
+            writer.element('tag', {'k': key, 'v': pair[0].tags[key]})
+        writer.end('way')
         if pair[1] is not None:
             for node in pair[1].nodes:
-                d_node = ET.SubElement(josm_root, 'node', node.attrib)
-                d_node.attrib['action'] = 'delete'
-            d_way = ET.SubElement(josm_root, 'way', pair[1].attrib)
-            d_way.attrib['action'] = 'delete'
+                writer.element('node', node.attrib, action='delete')
+            writer.element('way', pair[1].attrib, action='delete')
     uni_relation = []
     for pair in pairs:
         for relation in pair[2]:
             if int(relation.attrib['id']) not in uni_relation:
                 uni_relation.append(int(relation.attrib['id']))
-                e_rela = ET.SubElement(josm_root, 'relation', relation.attrib)
-                for member in relation.findall('member'):
-                    ET.SubElement(e_rela, 'member', member.attrib)
-                for tag in relation.findall('tag'):
-                    ET.SubElement(e_rela, 'tag', tag.attrib)
+                writer.write_element(relation)
 
-    return josm_root
+    writer.end('osm')
 
 def generate_josm_main():
     parser = argparse.ArgumentParser()
@@ -225,8 +225,5 @@ def generate_josm_main():
     for pair in replace_pairs:
        pair.append(make_relations(root, pair))
 
-    josm_root = generate_josm(replace_pairs)
-
-    # Make the xml pretty and print it out
-    josm_xml = xml.dom.minidom.parseString(ET.tostring(josm_root))
-    print josm_xml.toprettyxml(),
+    # Write the xml out as it is generated
+    generate_josm(XMLWriter(sys.stdout), replace_pairs, largest_bound)
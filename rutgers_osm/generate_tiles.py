@@ -1,63 +1,61 @@
 #!/usr/bin/env python
-from math import pi,cos,sin,log,exp,atan
 from subprocess import call
 import sys, os
-from Queue import Queue
+from Queue import Empty, Queue
+from itertools import chain, groupby
 import argparse
 
 import threading
+import time
+import multiprocessing
 
 import mapnik
 
-DEG_TO_RAD = pi/180
-RAD_TO_DEG = 180/pi
+from rutgers_osm import NJ_LATEST_SMALL, NJ_OLD_SMALL, NODE_CACHE, dirty_tiles, get_rutgers
+from rutgers_osm.checkpoint import Checkpoint, in_shard
+from rutgers_osm.metrics import RenderMetrics
+from rutgers_osm.nodestore import cache_path
+from rutgers_osm.tiles import GoogleProjection, ORDERS, iter_tile_range, iter_tiles, work_units
+from rutgers_osm.tilestore import STORES, EMPTY_TILE_SIZE
+
+from shapely.ops import unary_union
+from shapely.prepared import prep
 
 # Default number of rendering threads to spawn, should be roughly equal to number of CPU cores available
 NUM_THREADS = 4
 
+# Default metatile size, tiles are rendered in blocks of METATILE x METATILE
+METATILE = 8
+
+# Rendering backends, either threads in this process or worker processes
+BACKENDS = ('thread', 'process')
 
-def minmax (a,b,c):
-    a = max(a,b)
-    a = min(a,c)
-    return a
-
-class GoogleProjection:
-    def __init__(self,levels=18):
-        self.Bc = []
-        self.Cc = []
-        self.zc = []
-        self.Ac = []
-        c = 256
-        for d in range(0,levels):
-            e = c/2;
-            self.Bc.append(c/360.0)
-            self.Cc.append(c/(2 * pi))
-            self.zc.append((e,e))
-            self.Ac.append(c)
-            c *= 2
-                
-    def fromLLtoPixel(self,ll,zoom):
-         d = self.zc[zoom]
-         e = round(d[0] + ll[0] * self.Bc[zoom])
-         f = minmax(sin(DEG_TO_RAD * ll[1]),-0.9999,0.9999)
-         g = round(d[1] + 0.5*log((1+f)/(1-f))*-self.Cc[zoom])
-         return (e,g)
-     
-    def fromPixelToLL(self,px,zoom):
-         e = self.zc[zoom]
-         f = (px[0] - e[0])/self.Bc[zoom]
-         g = (px[1] - e[1])/-self.Cc[zoom]
-         h = RAD_TO_DEG * ( 2 * atan(exp(g)) - 0.5 * pi)
-         return (f,h)
+# Number of jobs handed to a worker process at a time
+PROCESS_BATCH = 8
 
 
+def metatile_jobs(tiles, metatile):
+    """Group a stream of (z, x, y) into (z, [(x, y), ...]) per metatile.
+    Tiles of the same metatile have to be consecutive, as iter_tiles
+    yields them.
+    """
+    key = lambda (z, x, y): (z, x // metatile, y // metatile)
+    for (z, mx, my), block in groupby(tiles, key):
+        yield z, [(x, y) for z, x, y in block]
+
 
 class RenderThread:
-    def __init__(self, tile_dir, mapfile, q, printLock, maxZoom, overwrite=False):
-        self.tile_dir = tile_dir
+    def __init__(self, store, mapfile, q, maxZoom, overwrite=False, metatile=1, worker=0, done=None, deadline=None):
+        self.store = store
         self.q = q
+        self.done = done
         self.m = mapnik.Map(256, 256)
-        self.printLock = printLock
+        self.worker = worker
+        self.metrics = RenderMetrics()
+        # Jobs taken off the queue after deadline aren't rendered, their
+        # tiles are collected in left instead
+        self.deadline = deadline
+        self.left = []
         # Load style XML
         mapnik.load_map(self.m, mapfile, True)
         # Obtain <Map> projection
@@ -65,17 +63,29 @@ class RenderThread:
         # Projects between tile pixel co-ordinates and LatLong (EPSG:4326)
         self.tileproj = GoogleProjection(maxZoom+1)
         self.overwrite = overwrite
+        self.metatile = metatile
+
 
+    def render_tile(self, x, y, z):
+        return self.render_metatile([(x, y)], z)[(x, y)]
 
-    def render_tile(self, tile_uri, x, y, z):
+
+    def render_metatile(self, tiles, z):
+        """Render the block covering (x, y) tiles as a single image,
+        slice it up into 256px tiles and hand them to the store.
+        Returns the encoded size of each tile.
+        """
+        x0 = min(x for x, y in tiles)
+        x1 = max(x for x, y in tiles) + 1
+        y0 = min(y for x, y in tiles)
+        y1 = max(y for x, y in tiles) + 1
 
         # Calculate pixel positions of bottom-left & top-right
-        p0 = (x * 256, (y + 1) * 256)
-        p1 = ((x + 1) * 256, y * 256)
+        p0 = (x0 * 256, y1 * 256)
+        p1 = (x1 * 256, y0 * 256)
 
         # Convert to LatLong (EPSG:4326)
-        l0 = self.tileproj.fromPixelToLL(p0, z);
-        l1 = self.tileproj.fromPixelToLL(p1, z);
+        l0, l1 = self.tileproj.fromPixelsToLL([p0, p1], z)
 
         # Convert to map projection (e.g. mercator co-ords EPSG:900913)
         c0 = self.prj.forward(mapnik.Coord(l0[0],l0[1]))
@@ -86,157 +96,365 @@ class RenderThread:
             bbox = mapnik.Box2d(c0.x,c0.y, c1.x,c1.y)
         else:
             bbox = mapnik.Envelope(c0.x,c0.y, c1.x,c1.y)
-        render_size = 256
-        self.m.resize(render_size, render_size)
+        width = (x1 - x0) * 256
+        height = (y1 - y0) * 256
+        self.m.resize(width, height)
         self.m.zoom_to_box(bbox)
         if(self.m.buffer_size < 128):
             self.m.buffer_size = 128
 
         # Render image with default Agg renderer
-        im = mapnik.Image(render_size, render_size)
+        start = time.time()
+        im = mapnik.Image(width, height)
         mapnik.render(self.m, im)
-        im.save(tile_uri, 'png256')
+        render_time = (time.time() - start) / len(tiles)
+
+        sizes = {}
+        for x, y in tiles:
+            start = time.time()
+            if width == 256 and height == 256:
+                data = im.tostring('png256')
+            else:
+                data = im.view((x - x0) * 256, (y - y0) * 256, 256, 256).tostring('png256')
+            encode_time = time.time() - start
+            size = self.store.write(z, x, y, data)
+            self.metrics.record(self.worker, z, x, y, render_time, encode_time,
+                                size, size == EMPTY_TILE_SIZE)
+            sizes[(x, y)] = size
+        return sizes
+
+
+    def render_job(self, name, z, tiles):
+        if self.overwrite:
+            missing = tiles
+        else:
+            missing = [(x, y) for x, y in tiles if not self.store.exists(z, x, y)]
+        sizes = {}
+        if missing:
+            sizes = self.render_metatile(missing, z)
+        if len(missing) < len(tiles):
+            self.metrics.skip(z, len(tiles) - len(missing))
+
+        lines = []
+        for x, y in tiles:
+            exists= ""
+            if (x, y) not in sizes:
+                exists= "exists"
+            empty= ''
+            if sizes.get((x, y)) == EMPTY_TILE_SIZE:
+                empty = " Empty Tile "
+            lines.append("{0} : {1} {2} {3} {4} {5}\n".format(name, z, x, y, exists, empty))
+        # A single write per job keeps workers' lines from interleaving
+        sys.stdout.write(''.join(lines))
 
 
     def loop(self):
         while True:
-            #Fetch a tile from the queue and render it
+            #Fetch a batch of jobs from the queue and render them
             r = self.q.get()
             if (r == None):
                 self.q.task_done()
                 break
-            else:
-                (name, tile_uri, x, y, z) = r
 
-            exists= ""
-            if not self.overwrite and os.path.isfile(tile_uri):
-                exists= "exists"
-            else:
-                self.render_tile(tile_uri, x, y, z)
-            bytes=os.stat(tile_uri)[6]
-            empty= ''
-            if bytes == 103:
-                empty = " Empty Tile "
-            self.printLock.acquire()
-            print name, ":", z, x, y, exists, empty
-            self.printLock.release()
+            units = []
+            for (name, z, tiles, unit) in r:
+                if self.deadline is not None and time.time() > self.deadline:
+                    self.left.extend((z, x, y) for x, y in tiles)
+                    continue
+                self.render_job(name, z, tiles)
+                if unit is not None:
+                    units.append(unit)
+            if units:
+                # A unit can be checkpointed as soon as it's reported,
+                # so its tiles mustn't be left in a store's buffer
+                self.store.flush()
+                for unit in units:
+                    self.done.put(unit)
             self.q.task_done()
 
 
-
-def render_tiles(bbox, mapfile, tile_dir, minZoom=1,maxZoom=18, name="unknown", num_threads=NUM_THREADS, tms_scheme=False):
+def render_process(store, mapfile, q, maxZoom, overwrite, metatile, worker, done, deadline, results):
+    """Worker process body, loads the stylesheet once and renders
+    batches of jobs until told to stop, then hands back the stats of its
+    copy of the store, its metrics and the tiles it had no time for."""
+    renderer = RenderThread(store, mapfile, q, maxZoom, overwrite, metatile, worker, done, deadline)
+    renderer.loop()
+    store.close()
+    sys.stdout.flush()
+    results.put((store.stats, renderer.metrics, renderer.left))
+
+
+class RenderPool:
+    """Rendering workers fed through a bounded queue. With the thread
+    backend every worker is a RenderThread in this process; with the
+    process backend every worker is a separate process with its own
+    mapnik.Map, so Python side work isn't serialised on the GIL.
+
+    Given a deadline, a time.time() value, workers stop rendering once
+    it passes, even jobs already queued, and the tiles of every job they
+    skipped end up in left after join().
+    """
+    def __init__(self, store, mapfile, maxZoom, num_threads=NUM_THREADS, overwrite=False, metatile=1, backend='thread', batch_size=None, deadline=None):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend {0}".format(backend))
+        if batch_size is None:
+            batch_size = PROCESS_BATCH if backend == 'process' else 1
+        self.batch_size = batch_size
+        self.batch = []
+        self.workers = []
+        self.store = store
+        self.results = None
+        self.renderers = []
+        self.metrics = RenderMetrics()
+        self.deadline = deadline
+        self.left = []
+
+        # Work units whose jobs have been rendered, see finished()
+        self.pending = 0
+        self.completed = []
+
+        if backend == 'process':
+            self.q = multiprocessing.JoinableQueue(32)
+            self.done = multiprocessing.Queue()
+            self.results = multiprocessing.Queue()
+        else:
+            self.q = Queue(32)
+            self.done = Queue()
+
+        for i in range(num_threads):
+            if backend == 'process':
+                worker = multiprocessing.Process(
+                    target=render_process,
+                    args=(store, mapfile, self.q, maxZoom, overwrite, metatile, i, self.done, deadline, self.results))
+            else:
+                renderer = RenderThread(store, mapfile, self.q, maxZoom, overwrite, metatile, i, self.done, deadline)
+                self.renderers.append(renderer)
+                worker = threading.Thread(target=renderer.loop)
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, job, unit=None):
+        """Queue job (name, z, tiles). When unit is given it is reported
+        by finished() once the job has been rendered."""
+        if unit is not None:
+            if self.deadline is not None:
+                # A skipped job would never report its unit
+                raise ValueError("Work units can't be used with a deadline")
+            self.pending += 1
+        self.batch.append(job + (unit,))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def finished(self):
+        """Units of the jobs rendered since the last call"""
+        completed = self.completed
+        self.completed = []
+        while self.pending:
+            try:
+                completed.append(self.done.get_nowait())
+            except Empty:
+                break
+            self.pending -= 1
+        return completed
+
+    def flush(self):
+        if self.batch:
+            try:
+                self.q.put(self.batch)
+            except KeyboardInterrupt:
+                raise SystemExit("Ctrl-c detected, exiting...")
+            self.batch = []
+
+    def join(self):
+        self.flush()
+        # Signal render workers to exit by sending empty request to queue
+        for worker in self.workers:
+            self.q.put(None)
+        # wait for pending rendering jobs to complete
+        self.q.join()
+        while self.pending:
+            self.completed.append(self.done.get())
+            self.pending -= 1
+        if self.results is not None:
+            # Drain before joining, a process won't exit with data unflushed
+            for worker in self.workers:
+                stats, metrics, left = self.results.get()
+                self.store.merge_stats(stats)
+                self.metrics.merge(metrics)
+                self.left.extend(left)
+        for worker in self.workers:
+            worker.join()
+        for renderer in self.renderers:
+            self.metrics.merge(renderer.metrics)
+            self.left.extend(renderer.left)
+
+
+
+def report_metrics(metrics, filename=None):
+    """Print the JSON summary of a run, and save it to filename"""
+    summary = metrics.to_json()
+    print summary
+    if filename is not None:
+        with open(filename, 'w') as f:
+            f.write(summary + '\n')
+
+
+def queue_tiles(pool, name, tiles, metatile=1):
+    """Submit a stream of (z, x, y) to the pool, one job per metatile"""
+    for z, block in metatile_jobs(tiles, metatile):
+        pool.put((name, z, block))
+
+
+def queue_units(pool, name, minZoom, maxZoom, bbox=None, shape=None, order='xy', metatile=1, checkpoint=None, shard=None):
+    """Render column by column (see tiles.work_units), skipping columns
+    listed in the checkpoint file and, given shard (i, n), every column
+    but each n-th one starting at i. Finished columns are added to the
+    checkpoint as they complete. Joins the pool.
+    """
+    proj = GoogleProjection(maxZoom + 1)
+    done = Checkpoint(checkpoint) if checkpoint is not None else None
+    prepared = prep(shape) if shape is not None else None
+    # Jobs still to render in each column
+    outstanding = {}
+
+    def finish(units):
+        for unit in units:
+            outstanding[unit] -= 1
+            if not outstanding[unit]:
+                del outstanding[unit]
+                if done is not None:
+                    done.add(unit)
+
+    skipped = 0
+    for index, (z, x0, x1, ymin, ymax) in enumerate(work_units(minZoom, maxZoom, bbox, shape, metatile, proj)):
+        unit = (z, x0, x1)
+        if not in_shard(index, shard):
+            continue
+        if done is not None and unit in done:
+            skipped += 1
+            continue
+
+        tiles = iter_tile_range(z, x0, ymin, x1, ymax, prepared, order, metatile, proj)
+        jobs = list(metatile_jobs(tiles, metatile))
+        if not jobs:
+            if done is not None:
+                done.add(unit)
+            continue
+        outstanding[unit] = len(jobs)
+        for z, block in jobs:
+            pool.put((name, z, block), unit)
+        finish(pool.finished())
+
+    pool.join()
+    finish(pool.finished())
+    if done is not None:
+        print "{0} columns skipped, {1} done in {2}".format(skipped, len(done), checkpoint)
+        done.close()
+
+
+def render_tiles(bbox, mapfile, tile_dir, minZoom=1,maxZoom=18, name="unknown", num_threads=NUM_THREADS, tms_scheme=False, metatile=1, backend='thread', shape=None, order='xy', store='file', metrics=None, checkpoint=None, shard=None):
     print "render_tiles(",bbox, mapfile, tile_dir, minZoom,maxZoom, name,")"
 
-    # Launch rendering threads
-    queue = Queue(32)
-    printLock = threading.Lock()
-    renderers = {}
-    for i in range(num_threads):
-        renderer = RenderThread(tile_dir, mapfile, queue, printLock, maxZoom)
-        render_thread = threading.Thread(target=renderer.loop)
-        render_thread.start()
-        #print "Started render thread %s" % render_thread.getName()
-        renderers[i] = render_thread
-
-    if not os.path.isdir(tile_dir):
-         os.mkdir(tile_dir)
-
-    gprj = GoogleProjection(maxZoom+1) 
-
-    ll0 = (bbox[0],bbox[3])
-    ll1 = (bbox[2],bbox[1])
-
-    for z in range(minZoom,maxZoom + 1):
-        px0 = gprj.fromLLtoPixel(ll0,z)
-        px1 = gprj.fromLLtoPixel(ll1,z)
-
-        # check if we have directories in place
-        zoom = "%s" % z
-        if not os.path.isdir(tile_dir + zoom):
-            os.mkdir(tile_dir + zoom)
-        for x in range(int(px0[0]/256.0),int(px1[0]/256.0)+1):
-            # Validate x co-ordinate
-            if (x < 0) or (x >= 2**z):
-                continue
-            # check if we have directories in place
-            str_x = "%s" % x
-            if not os.path.isdir(tile_dir + zoom + '/' + str_x):
-                os.mkdir(tile_dir + zoom + '/' + str_x)
-            for y in range(int(px0[1]/256.0),int(px1[1]/256.0)+1):
-                # Validate x co-ordinate
-                if (y < 0) or (y >= 2**z):
-                    continue
-                # flip y to match OSGEO TMS spec
-                if tms_scheme:
-                    str_y = "%s" % ((2**z-1) - y)
-                else:
-                    str_y = "%s" % y
-                tile_uri = tile_dir + zoom + '/' + str_x + '/' + str_y + '.png'
-                # Submit tile to be rendered into the queue
-                t = (name, tile_uri, x, y, z)
-                try:
-                    queue.put(t)
-                except KeyboardInterrupt:
-                    raise SystemExit("Ctrl-c detected, exiting...")
-
-    # Signal render threads to exit by sending empty request to queue
-    for i in range(num_threads):
-        queue.put(None)
-    # wait for pending rendering jobs to complete
-    queue.join()
-    for i in range(num_threads):
-        renderers[i].join()
-
-
-def render_specific(tiles, mapfile, tile_dir, name="unknown", num_threads=NUM_THREADS, maxZoom=18):
-    # Launch rendering threads
-    queue = Queue(32)
-    printLock = threading.Lock()
-    renderers = {}
-    for i in range(num_threads):
-        renderer = RenderThread(tile_dir, mapfile, queue, printLock, maxZoom, overwrite=True)
-        render_thread = threading.Thread(target=renderer.loop)
-        render_thread.start()
-        #print "Started render thread %s" % render_thread.getName()
-        renderers[i] = render_thread
-
-    if not os.path.isdir(tile_dir):
-        os.mkdir(tile_dir)
-
-    for tile in tiles:
-        tile = tile.rstrip()
-        z, x, y = [int(dim) for dim in tile.split('/')]
-        tile_uri = os.path.join(tile_dir, tile) + '.png'
-        t = (name, tile_uri, x, y, z)
-        if not os.path.isdir(tile_dir + str(z)):
-            os.mkdir(tile_dir + str(z))
-        if not os.path.isdir(tile_dir + str(z) + '/' + str(x)):
-            os.mkdir(tile_dir + str(z) + '/' + str(x))
-        try:
-            queue.put(t)
-        except KeyboardInterrupt:
-            raise SystemExit("Ctrl-c detected, exiting...")
-
-    # Signal render threads to exit by sending empty request to queue
-    for i in range(num_threads):
-        queue.put(None)
-    # wait for pending rendering jobs to complete
-    queue.join()
-    for i in range(num_threads):
-        renderers[i].join()
+    # Launch rendering workers
+    store = STORES[store](tile_dir, tms_scheme)
+    pool = RenderPool(store, mapfile, maxZoom, num_threads, metatile=metatile, backend=backend)
+
+    if checkpoint is None and shard is None:
+        tiles = iter_tiles(minZoom, maxZoom, bbox, shape, order, metatile)
+        queue_tiles(pool, name, tiles, metatile)
+        pool.join()
+    else:
+        queue_units(pool, name, minZoom, maxZoom, bbox, shape, order, metatile, checkpoint, shard)
+
+    store.close()
+    print store.report()
+    report_metrics(pool.metrics, metrics)
+
+
+def render_specific(tiles, mapfile, tile_dir, name="unknown", num_threads=NUM_THREADS, minZoom=0, maxZoom=18, metatile=1, backend='thread', store='file', order='xy', expand_children=False, expand_parents=False, shape=None, priority='zoom', budget=None, remaining=None, metrics=None):
+    """Re-render a stream of dirty (z, x, y) tiles. Each tile is
+    rendered once however often it is listed, most important first (see
+    dirty_tiles.prioritized). Given a budget in seconds no more work is
+    started once it runs out, and the tiles that were left are written
+    to the file remaining so the next run can pick them up.
+    """
+    dirty = dirty_tiles.dirty_set(tiles, minZoom, maxZoom, expand_children, expand_parents)
+    dirty = dirty_tiles.prioritized(dirty, order, metatile, shape, priority)
+
+    # Launch rendering workers
+    store = STORES[store](tile_dir)
+    deadline = time.time() + budget if budget is not None else None
+    pool = RenderPool(store, mapfile, maxZoom, num_threads, overwrite=True, metatile=metatile, backend=backend, deadline=deadline)
+
+    left = []
+    for z, block in metatile_jobs(dirty, metatile):
+        if left or (deadline is not None and time.time() > deadline):
+            left.extend((z, x, y) for x, y in block)
+        else:
+            pool.put((name, z, block))
+
+    pool.join()
+    # Queued jobs the workers had no time for come before anything that
+    # was never queued
+    left = pool.left + left
+    store.close()
+    print store.report()
+    report_metrics(pool.metrics, metrics)
+
+    if left:
+        print "Out of time, {0} tiles left to render".format(len(left))
+    if remaining is not None:
+        with open(remaining, 'w') as f:
+            dirty_tiles.write_tiles(f, left)
+
+
+def shard_arg(value):
+    """Parse i/n for --shard"""
+    try:
+        i, n = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/n, not {0}".format(value))
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError("shard {0} doesn't fall in 0..{1}".format(i, n - 1))
+    return (i, n)
 
 
 def generate_tiles_main():
     parser = argparse.ArgumentParser(prog='render_tiles', description='Renders mapnik tiles')
     parser.add_argument('stylesheet', help='The maps stylesheet to use')
-    parser.add_argument('output_dir', help='The tiles directory')
+    parser.add_argument('output_dir', help='The tiles directory, or database file with --store mbtiles')
     parser.add_argument('-b', '--bbox', nargs=4, default=[-180.0, -90, 180.0, 90.0], type=float, help='bounding box that will be rendered')
-    parser.add_argument('-u', '--update-dirty', type=file)
-    parser.add_argument('-z', '--min-zoom', default=0)
-    parser.add_argument('-Z', '--max-zoom', default=18)
+    parser.add_argument('-u', '--update-dirty', nargs='+', type=file, default=[], help='Re-render the z/x/y tiles listed in these files')
+    parser.add_argument('-x', '--change', nargs='+', default=[], help='Re-render the tiles under everything these osmChange files touch')
+    parser.add_argument('--latest-crop', default=NJ_LATEST_SMALL, help='With -x, osm file to look up nodes in')
+    parser.add_argument('--old-crop', default=NJ_OLD_SMALL, help='With -x, osm file from before the changes')
+    parser.add_argument('--node-cache', default=NODE_CACHE, help='With -x, directory the nodes of the crops are cached in')
+    parser.add_argument('-z', '--min-zoom', default=0, type=int)
+    parser.add_argument('-Z', '--max-zoom', default=18, type=int)
+    parser.add_argument('-m', '--metatile', default=METATILE, type=int, help='Render tiles in blocks of N x N')
+    parser.add_argument('-n', '--num-threads', default=NUM_THREADS, type=int, help='Number of rendering workers')
+    parser.add_argument('-B', '--backend', default='thread', choices=BACKENDS, help='Render with threads or worker processes')
+    parser.add_argument('-c', '--campus', action='store_true', help='Only render tiles touching the campus polygons')
+    parser.add_argument('-o', '--order', default='xy', choices=ORDERS, help='Order to render tiles in')
+    parser.add_argument('--expand-children', action='store_true', help='With -u, also re-render the tiles under each dirty tile at the deepest zoom listed down to the max zoom')
+    parser.add_argument('--expand-parents', action='store_true', help='With -u, also re-render the tiles above each dirty tile up to the min zoom')
+    parser.add_argument('-p', '--priority', default='zoom', choices=dirty_tiles.PRIORITIES, help='With -u, render low zooms or campus tiles first')
+    parser.add_argument('-t', '--time-budget', type=float, help='With -u, stop starting new tiles after this many seconds')
+    parser.add_argument('-r', '--remaining', help='With -u, write the tiles left after the time budget to this file')
+    parser.add_argument('-k', '--checkpoint', help='Record finished columns in this file and skip them when restarted')
+    parser.add_argument('--shard', type=shard_arg, help='Render only shard i/n of the columns, for splitting a run across n machines')
+    parser.add_argument('-M', '--metrics', help='Also write the JSON render metrics to this file')
+    parser.add_argument('-s', '--store', default='file', choices=sorted(STORES), help='How to store rendered tiles')
     args = parser.parse_args()
 
-    if args.update_dirty:
-        render_specific(args.update_dirty.readlines(), args.stylesheet, args.output_dir, args.max_zoom)
+    shape = unary_union(get_rutgers()) if args.campus else None
+
+    if args.update_dirty or args.change:
+        tiles = dirty_tiles.parse_tiles(chain(*args.update_dirty))
+        if args.change:
+            node_caches = [cache_path(args.node_cache, crop) for crop in (args.latest_crop, args.old_crop)]
+            tiles = chain(tiles, dirty_tiles.change_file_tiles(args.change, args.min_zoom, args.max_zoom, args.latest_crop, args.old_crop, node_caches))
+        campus = unary_union(get_rutgers())
+        render_specific(tiles, args.stylesheet, args.output_dir, minZoom=args.min_zoom, maxZoom=args.max_zoom, num_threads=args.num_threads, metatile=args.metatile, backend=args.backend, store=args.store, order=args.order, expand_children=args.expand_children, expand_parents=args.expand_parents, shape=campus, priority=args.priority, budget=args.time_budget, remaining=args.remaining, metrics=args.metrics)
     else:
-        render_tiles(args.bbox, args.stylesheet, args.output_dir, args.min_zoom, args.max_zoom, "World")
+        render_tiles(args.bbox, args.stylesheet, args.output_dir, args.min_zoom, args.max_zoom, "World", num_threads=args.num_threads, metatile=args.metatile, backend=args.backend, shape=shape, order=args.order, store=args.store, metrics=args.metrics, checkpoint=args.checkpoint, shard=args.shard)
@@ -2,15 +2,16 @@
 from lxml.cssselect import CSSSelector
 import lxml.html
 import sys
-import urllib2
 from datetime import datetime
 
+from rutgers_osm.download import download
+
 NJ_LATEST = ("http://download.geofabrik.de/"
                      "north-america/us/new-jersey-latest.osm.pbf")
 
 def get_new_jersey(outfile):
-    with open(outfile, 'w') as f:
-        f.write(urllib2.urlopen(NJ_LATEST).read())
+    if not download(NJ_LATEST, outfile):
+        print "{0} is already up to date".format(outfile)
 
 def get_new_jersey_main():
     if len(sys.argv) != 2:
@@ -0,0 +1,128 @@
+import heapq
+import json
+import time
+
+# Upper bounds in seconds of the per tile render time histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Slowest tiles remembered per zoom
+SLOWEST = 5
+
+
+def bucket(seconds):
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(BUCKETS)
+
+
+def bucket_labels():
+    return ["<={0}".format(bound) for bound in BUCKETS] + [">{0}".format(BUCKETS[-1])]
+
+
+class RenderMetrics(object):
+    """Per tile render measurements, added up per zoom and per worker.
+    Every worker keeps its own copy, so recording needs no locking, and
+    the copies are merged once rendering is done.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.zooms = {}
+        self.workers = {}
+
+    def zoom(self, z):
+        if z not in self.zooms:
+            self.zooms[z] = {
+                'tiles': 0, 'empty': 0, 'skipped': 0, 'bytes': 0,
+                'render_time': 0.0, 'encode_time': 0.0,
+                'histogram': [0] * (len(BUCKETS) + 1),
+                'slowest': [],
+            }
+        return self.zooms[z]
+
+    def worker(self, worker):
+        if worker not in self.workers:
+            self.workers[worker] = {'tiles': 0, 'busy': 0.0}
+        return self.workers[worker]
+
+    def record(self, worker, z, x, y, render_time, encode_time, size, empty):
+        """Add one rendered tile. render_time is the tile's share of
+        rendering its metatile."""
+        total = render_time + encode_time
+        zoom = self.zoom(z)
+        zoom['tiles'] += 1
+        zoom['empty'] += int(empty)
+        zoom['bytes'] += size
+        zoom['render_time'] += render_time
+        zoom['encode_time'] += encode_time
+        zoom['histogram'][bucket(total)] += 1
+        tile = "{0}/{1}/{2}".format(z, x, y)
+        if len(zoom['slowest']) < SLOWEST:
+            heapq.heappush(zoom['slowest'], (total, tile))
+        else:
+            heapq.heappushpop(zoom['slowest'], (total, tile))
+
+        stats = self.worker(worker)
+        stats['tiles'] += 1
+        stats['busy'] += total
+
+    def skip(self, z, count=1):
+        """Count tiles that were already rendered"""
+        self.zoom(z)['skipped'] += count
+
+    def merge(self, other):
+        """Add in the measurements of another worker's RenderMetrics"""
+        self.start = min(self.start, other.start)
+        for z, theirs in other.zooms.iteritems():
+            zoom = self.zoom(z)
+            for key in ('tiles', 'empty', 'skipped', 'bytes', 'render_time', 'encode_time'):
+                zoom[key] += theirs[key]
+            zoom['histogram'] = [a + b for a, b in zip(zoom['histogram'], theirs['histogram'])]
+            zoom['slowest'] = heapq.nlargest(SLOWEST, zoom['slowest'] + theirs['slowest'])
+            heapq.heapify(zoom['slowest'])
+        for worker, theirs in other.workers.iteritems():
+            stats = self.worker(worker)
+            stats['tiles'] += theirs['tiles']
+            stats['busy'] += theirs['busy']
+
+    def summary(self, elapsed=None):
+        if elapsed is None:
+            elapsed = time.time() - self.start
+        labels = bucket_labels()
+        tiles = sum(zoom['tiles'] for zoom in self.zooms.itervalues())
+
+        zooms = {}
+        for z, zoom in self.zooms.iteritems():
+            busy = zoom['render_time'] + zoom['encode_time']
+            zooms[str(z)] = {
+                'tiles': zoom['tiles'],
+                'empty': zoom['empty'],
+                'skipped': zoom['skipped'],
+                'bytes': zoom['bytes'],
+                'render_time': round(zoom['render_time'], 3),
+                'encode_time': round(zoom['encode_time'], 3),
+                'tiles_per_busy_sec': round(zoom['tiles'] / busy, 2) if busy else None,
+                'histogram': [[label, count] for label, count in zip(labels, zoom['histogram'])],
+                'slowest': [[tile, round(seconds, 3)] for seconds, tile
+                            in sorted(zoom['slowest'], reverse=True)],
+            }
+
+        workers = {}
+        for worker, stats in self.workers.iteritems():
+            workers[str(worker)] = {
+                'tiles': stats['tiles'],
+                'busy': round(stats['busy'], 3),
+                'utilisation': round(stats['busy'] / elapsed, 3) if elapsed else None,
+            }
+
+        return {
+            'elapsed': round(elapsed, 3),
+            'tiles': tiles,
+            'tiles_per_sec': round(tiles / elapsed, 2) if elapsed else None,
+            'zooms': zooms,
+            'workers': workers,
+        }
+
+    def to_json(self, elapsed=None):
+        return json.dumps(self.summary(elapsed), indent=2, sort_keys=True)
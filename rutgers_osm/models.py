@@ -1,20 +1,91 @@
 from rutgers_osm import max_bbox, osm_func, osc_func, get_bbox_shape
+from rutgers_osm.nodestore import NodeStore
+from rutgers_osm.xmlwriter import XMLWriter
+import os
 import xml.etree.ElementTree as ET
 
+from shapely.geometry import LineString, Point, Polygon
+from shapely.ops import unary_union
+
 
 CREATE = "create"
 MODIFY = "modify"
 DELETE = "delete"
 BOUNDS = "bounds"
 
+ELEMENTS = ("node", "way", "relation")
+
+
+def iterparse_elements(source):
+    """Incrementally parse an osm or osmChange file, yielding
+    (parent tag, element) for every node, way and relation.
+    Elements are cleared once the caller moves on, so only the
+    current element is ever held in memory.
+    """
+    parents = []
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag in ELEMENTS and parents:
+            yield parents[-1].tag, elem
+            parents[-1].clear()
+
+
+def write_change_without(source, exclude, f):
+    """Copy osmChange file source to f, less the elements whose
+    (tag, id) is in exclude. Elements are copied from the xml as they
+    are, so ones the model can't resolve, like a way none of whose
+    nodes are in the crops, are kept rather than dropped.
+    """
+    writer = XMLWriter(f)
+    writer.start('osmChange', version='0.6')
+    section = None
+    for change_t, element in iterparse_elements(source):
+        if (element.tag, element.attrib['id']) in exclude:
+            continue
+        # Sections are kept in source order, so nodes still come before
+        # the ways that use them
+        if change_t != section:
+            if section is not None:
+                writer.end(section)
+            section = change_t
+            writer.start(section)
+        writer.write_element(element)
+    if section is not None:
+        writer.end(section)
+    writer.end('osmChange')
+
+
+def read_nodes(source, store, wanted=None):
+    """Add the nodes at the start of osm file source to a NodeStore,
+    only the ids in wanted if it's given"""
+    for parent, elem in iterparse_elements(source):
+        if elem.tag != "node":
+            break
+        if wanted is None or elem.attrib['id'] in wanted:
+            store.add(elem.attrib['id'],
+                      float(elem.attrib['lon']),
+                      float(elem.attrib['lat']))
+
+
+def union_bounds(bounds):
+    """Bounds covering every (minx, miny, maxx, maxy) in bounds"""
+    minxs, minys, maxxs, maxys = zip(*bounds)
+    return (min(minxs), min(minys), max(maxxs), max(maxys))
+
 
 class Refs:
     NODE = 0
     WAY = 1
     RELATION = 2
 
-    def __init__(self):
+    def __init__(self, node_index=None):
         self.nodes = {}
+        self.node_store = NodeStore()
+        # NodeIndex of the full extract for nodes the crops don't have
+        self.node_index = node_index
         self.ways = {}
         self.relations = {}
 
@@ -30,6 +101,9 @@ class Refs:
         if k not in self.nodes:
             self.nodes[k] = v
 
+    def put_coords(self, k, lon, lat):
+        self.node_store.add(k, lon, lat)
+
     def put_way(self, k, v):
         if k not in self.ways:
             self.ways[k] = v
@@ -39,10 +113,19 @@ class Refs:
             self.relations[k] = v
 
     def get_node(self, k):
+        """Nodes from the change itself are kept whole, anything else is
+        materialised from the node store, or failing that the node index,
+        on demand.
+        """
         try:
             return self.nodes[k]
         except KeyError:
-            return None
+            coords = self.node_store.get(k)
+            if coords is None and self.node_index is not None:
+                coords = self.node_index.get(k)
+            if coords is None:
+                return None
+            return Node(id=k, lon=repr(coords[0]), lat=repr(coords[1]))
 
     def get_way(self, k):
         try:
@@ -59,11 +142,34 @@ class Refs:
     def populate_nodes(self, context):
         for elem in context.getroot():
             if elem.tag == "node":
-                node = Node.from_xml(elem)
-                self.put_node(node.osm_id, node)
+                self.put_coords(elem.attrib['id'],
+                                float(elem.attrib['lon']),
+                                float(elem.attrib['lat']))
             if elem.tag == "way" or elem.tag == "relation":
                 break
 
+    def populate_nodes_from_file(self, source, wanted=None):
+        """Stream nodes from an osm file, keeping only the ids in wanted
+        (or all of them if wanted is None).
+        """
+        read_nodes(source, self.node_store, wanted)
+
+    def populate_nodes_cached(self, source, path, wanted=None):
+        """populate_nodes_from_file, with every node of source saved to
+        path, its cache file (see nodestore.cache_path), so a later run
+        given the same file loads the arrays instead of parsing it.
+        """
+        store = NodeStore.load(path) if os.path.isfile(path) else None
+        if store is None:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            store = NodeStore()
+            read_nodes(source, store)
+            store.save(path)
+        if wanted is not None:
+            store = store.subset(wanted)
+        self.node_store.extend(store)
+
 
 class OSMData(object):
     def __init__(self, tags=None, **kwargs):
@@ -73,9 +179,61 @@ class OSMData(object):
         self.tags = tags or {}
         self.kwargs = kwargs
 
-    def tags_to_xml(self, root):
+        self._bounds = None
+        self._parents = []
+
+    def bounds(self):
+        if self._bounds is None:
+            self._bounds = self.compute_bounds()
+        return self._bounds
+
+    def add_parent(self, parent):
+        self._parents.append(parent)
+
+    def invalidate_bounds(self):
+        """Drop the cached bounds here and in every way/relation
+        containing this element.
+        """
+        self._bounds = None
+        for parent in self._parents:
+            parent.invalidate_bounds()
+
+    def extend_bounds(self, bounds):
+        """Grow the cached bounds to cover bounds, passing it up to every
+        parent. Elements that have not computed their bounds yet are left
+        alone, they will pick it up when they do.
+        """
+        if self._bounds is None:
+            return
+        self._bounds = max_bbox(self._bounds, bounds)
+        for parent in self._parents:
+            parent.extend_bounds(bounds)
+
+    def xml_attrib(self):
+        attrib = dict(self.kwargs)
+        attrib['id'] = self.osm_id
+        return attrib
+
+    def xml_children(self):
+        """(tag, attrib) for every child element, tags last"""
         for tag in self.tags:
-            ET.SubElement(root, 'tag', k=tag, v=self.tags[tag])
+            yield 'tag', {'k': tag, 'v': self.tags[tag]}
+
+    def to_xml(self):
+        root = ET.Element(self.TAG, self.xml_attrib())
+        for tag, attrib in self.xml_children():
+            ET.SubElement(root, tag, attrib)
+        return root
+
+    def write_xml(self, writer):
+        children = list(self.xml_children())
+        if not children:
+            writer.element(self.TAG, self.xml_attrib())
+            return
+        writer.start(self.TAG, self.xml_attrib())
+        for tag, attrib in children:
+            writer.element(tag, attrib)
+        writer.end(self.TAG)
 
     def get_bbox(self):
         return get_bbox_shape(self.bounds())
@@ -101,13 +259,18 @@ class Node(OSMData):
     def bounds(self):
         return (self.lon, self.lat, self.lon, self.lat)
 
-    def to_xml(self):
-        node_root = ET.Element('node', id=self.osm_id, **self.kwargs)
-        self.tags_to_xml(node_root)
-        return node_root
+    def compute_bounds(self):
+        return self.bounds()
+
+    def geometry(self):
+        return Point(self.lon, self.lat)
 
     @staticmethod
     def from_xml(xml):
+        # A delete needn't say where the node was, there's nothing to
+        # place without it
+        if 'lon' not in xml.attrib or 'lat' not in xml.attrib:
+            return None
         tags = OSMData.tags_from_xml(xml)
         return Node(tags, **xml.attrib)
 
@@ -119,30 +282,68 @@ class Way(OSMData):
         super(Way, self).__init__(tags, **kwargs)
         self.nodes = nodes or []
 
-    def bounds(self):
-        return reduce(max_bbox, [node.bounds() for node in self.nodes])
-
-    def to_xml(self):
-        way_root = ET.Element('way', id=self.osm_id, **self.kwargs)
-
-        for node in self.nodes:
-            ET.SubElement(way_root, 'nd', ref=node.osm_id)
-
-        self.tags_to_xml(way_root)
-
-        return way_root
+    @property
+    def nodes(self):
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self._nodes = nodes
+        # Every nd ref from the source xml, including ones that couldn't
+        # be resolved to a node. Written back out by to_xml.
+        self.node_refs = None
+        for node in nodes:
+            node.add_parent(self)
+        self.invalidate_bounds()
+
+    def add_node(self, node):
+        self._nodes.append(node)
+        if self.node_refs is not None:
+            self.node_refs.append(node.osm_id)
+        node.add_parent(self)
+        self.extend_bounds(node.bounds())
+
+    def compute_bounds(self):
+        lons = [node.lon for node in self._nodes]
+        lats = [node.lat for node in self._nodes]
+        return (min(lons), min(lats), max(lons), max(lats))
+
+    def geometry(self):
+        """Closed ways are areas, anything else a line"""
+        coords = [(node.lon, node.lat) for node in self._nodes]
+        if len(set(coords)) == 1:
+            return Point(coords[0])
+        if len(set(coords)) >= 3 and coords[0] == coords[-1]:
+            polygon = Polygon(coords)
+            # Self intersecting areas are fixed up rather than dropped
+            return polygon if polygon.is_valid else polygon.buffer(0)
+        return LineString(coords)
+
+    def xml_children(self):
+        node_refs = self.node_refs
+        if node_refs is None:
+            node_refs = [node.osm_id for node in self.nodes]
+        for ref in node_refs:
+            yield 'nd', {'ref': ref}
+
+        for child in super(Way, self).xml_children():
+            yield child
 
     @staticmethod
     def from_xml(xml, refs):
         nodes = []
+        node_refs = []
         tags = OSMData.tags_from_xml(xml)
         for e in xml:
             if e.tag == "nd":
+                node_refs.append(e.attrib['ref'])
                 found_node = refs.get_node(e.attrib['ref'])
                 if found_node is not None:
                     nodes.append(found_node)
         if nodes:
-            return Way(nodes, tags, **xml.attrib)
+            way = Way(nodes, tags, **xml.attrib)
+            way.node_refs = node_refs
+            return way
 
 
 class Relation(OSMData):
@@ -152,25 +353,54 @@ class Relation(OSMData):
         super(Relation, self).__init__(tags, **kwargs)
         self.members = members or []
 
-    def bounds(self):
-        return reduce(max_bbox, [member.bounds() for member, role in self.members])
-
-    def to_xml(self):
-        rel_root = ET.Element('relation', id=self.osm_id, **self.kwargs)
-
-        for member, role in self.members:
-            ET.SubElement(rel_root, "member", type=member.TAG, ref=member.osm_id, role=role)
-
-        self.tags_to_xml(rel_root)
-
-        return rel_root
+    @property
+    def members(self):
+        return self._members
+
+    @members.setter
+    def members(self, members):
+        self._members = members
+        # Every (type, ref, role) from the source xml, including members
+        # that couldn't be resolved. Written back out by to_xml.
+        self.member_refs = None
+        for member, role in members:
+            member.add_parent(self)
+        self.invalidate_bounds()
+
+    def add_member(self, member, role):
+        self._members.append((member, role))
+        if self.member_refs is not None:
+            self.member_refs.append((member.TAG, member.osm_id, role))
+        member.add_parent(self)
+        self.extend_bounds(member.bounds())
+
+    def compute_bounds(self):
+        return union_bounds([member.bounds() for member, role in self._members])
+
+    def geometry(self):
+        return unary_union([member.geometry() for member, role in self._members])
+
+    def xml_children(self):
+        member_refs = self.member_refs
+        if member_refs is None:
+            member_refs = [(member.TAG, member.osm_id, role)
+                           for member, role in self.members]
+        for mtype, ref, role in member_refs:
+            yield 'member', {'type': mtype, 'ref': ref, 'role': role}
+
+        for child in super(Relation, self).xml_children():
+            yield child
 
     @staticmethod
     def from_xml(xml, refs):
         tags = OSMData.tags_from_xml(xml)
         members = []
+        member_refs = []
         for member in xml:
             if member.tag == "member":
+                member_refs.append((member.attrib['type'],
+                                    member.attrib['ref'],
+                                    member.attrib['role']))
                 ref_get = osm_func(
                     member.attrib['type'],
                     refs.get_node,
@@ -182,7 +412,9 @@ class Relation(OSMData):
                     if found_member is not None:
                         members.append((found_member, member.attrib['role']))
         if members:
-            return Relation(members, tags, **xml.attrib)
+            relation = Relation(members, tags, **xml.attrib)
+            relation.member_refs = member_refs
+            return relation
 
 
 class OSM:
@@ -190,8 +422,7 @@ class OSM:
         self.elements = elements or []
 
     def bounds(self):
-        return (self.shape.bounds or
-                reduce(max_bbox, [element.bounds() for node in self.elements]))
+        return union_bounds([element.bounds() for element in self.elements])
 
     def to_xml(self):
         osm_root = ET.Element('osm', version='0.6')
@@ -199,6 +430,74 @@ class OSM:
             osm_root.append(element.to_xml())
         return osm_root
 
+    def write(self, f):
+        """Write indented xml to f without building a tree"""
+        writer = XMLWriter(f)
+        writer.start('osm', version='0.6')
+        for element in self.elements:
+            element.write_xml(writer)
+        writer.end('osm')
+
+    @staticmethod
+    def from_file(source, keep=None):
+        """Stream an osm file, returning only the elements whose
+        (tag, id) is in keep, or all of them if keep is None. Every node
+        is still used to resolve the ways and relations kept, but only
+        the ways and relations they need are built (see OSM.needed).
+        """
+        elements = []
+        refs = Refs()
+        needed = None if keep is None else OSM.needed(source, keep)
+
+        for parent, element in iterparse_elements(source):
+            key = (element.tag, element.attrib['id'])
+            kept = keep is None or key in keep
+            if element.tag == "node" and not kept:
+                refs.put_coords(element.attrib['id'],
+                                float(element.attrib['lon']),
+                                float(element.attrib['lat']))
+                continue
+            if needed is not None and key not in needed:
+                continue
+            func = osm_func(
+                element.tag,
+                lambda: Node.from_xml(element),
+                lambda: Way.from_xml(element, refs),
+                lambda: Relation.from_xml(element, refs)
+            )
+            if func:
+                value = func()
+                if value:
+                    refs.put(value.osm_id, value)
+                    if kept:
+                        elements.append(value)
+        return OSM(elements)
+
+    @staticmethod
+    def needed(source, keep):
+        """keep plus every member of a relation in keep, and of the
+        relations among those, in osm file source. Files are only read
+        through again when keep has a relation in it.
+        """
+        needed = set(keep)
+        todo = [osm_id for tag, osm_id in keep if tag == "relation"]
+        if not todo:
+            return needed
+
+        members = {}
+        for parent, element in iterparse_elements(source):
+            if element.tag == "relation":
+                members[element.attrib['id']] = [
+                    (member.attrib['type'], member.attrib['ref'])
+                    for member in element if member.tag == "member"]
+        while todo:
+            for member in members.get(todo.pop(), []):
+                if member not in needed:
+                    needed.add(member)
+                    if member[0] == "relation":
+                        todo.append(member[1])
+        return needed
+
     @staticmethod
     def from_xml(xml, context):
         elements = []
@@ -236,6 +535,23 @@ class OSMChange:
         return "OSMChange(create={}, modify={}, delete={})".format(
             str(self.create), str(self.modify), str(self.delete))
 
+    def __sub__(self, other):
+        """Changes in self for elements that other doesn't touch,
+        matched by element type and id.
+        """
+        seen = other.element_ids()
+
+        def keep(elements):
+            return [element for element in elements
+                    if (element.TAG, element.osm_id) not in seen]
+
+        return OSMChange(keep(self.create), keep(self.modify), keep(self.delete))
+
+    def element_ids(self):
+        """(tag, id) of every element changed"""
+        return set((element.TAG, element.osm_id)
+                   for element in self.create + self.modify + self.delete)
+
     def to_xml(self):
         osc_root = ET.Element('osmChange', version='0.6')
         creations = ET.SubElement(osc_root, "create")
@@ -253,11 +569,24 @@ class OSMChange:
 
         return osc_root
 
+    def write(self, f):
+        """Write indented xml to f without building a tree"""
+        writer = XMLWriter(f)
+        writer.start('osmChange', version='0.6')
+        for change_t, elements in [(CREATE, self.create),
+                                   (MODIFY, self.modify),
+                                   (DELETE, self.delete)]:
+            if not elements:
+                writer.element(change_t)
+                continue
+            writer.start(change_t)
+            for element in elements:
+                element.write_xml(writer)
+            writer.end(change_t)
+        writer.end('osmChange')
+
     @staticmethod
     def from_xml(xml, *contexts):
-        create = []
-        modify = []
-        delete = []
         refs = Refs()
 
         for i, context in enumerate(contexts):
@@ -265,21 +594,68 @@ class OSMChange:
             refs.populate_nodes(context)
 
         print "Parsing changes"
-        for change_t in xml.getroot():
-            for element in change_t:
-                if element.tag == BOUNDS:
-                    continue
-                func = osm_func(
-                    element.tag,
-                    lambda: Node.from_xml(element),
-                    lambda: Way.from_xml(element, refs),
-                    lambda: Relation.from_xml(element, refs)
-                )
-                if func is not None:
-                    value = func()
-                    if value is not None:
-                        refs.put(value.osm_id, value)
-                        ctype = osc_func(change_t.tag, create, modify, delete)
-                        if ctype is not None:
-                            ctype.append(value)
+        return OSMChange.from_elements(
+            ((change_t.tag, element)
+             for change_t in xml.getroot() for element in change_t),
+            refs
+        )
+
+    @staticmethod
+    def from_file(source, *crops, **options):
+        """Streaming version of from_xml that takes file names instead
+        of parsed trees. Only the nodes referenced by the change are
+        kept from the crop files. Given a node_caches option, the cache
+        file of each crop, the crops' nodes are loaded from or saved to
+        those instead of parsed (see Refs.populate_nodes_cached). Nodes
+        in neither crop are looked up in the node_index option, a
+        NodeIndex, if there is one.
+        """
+        refs = Refs(options.get('node_index'))
+        node_caches = options.get('node_caches')
+        wanted = OSMChange.referenced_nodes(source)
+
+        for i, crop in enumerate(crops):
+            print "Parsing refs {0} of {1}".format(i + 1, len(crops))
+            if node_caches is None:
+                refs.populate_nodes_from_file(crop, wanted)
+            else:
+                refs.populate_nodes_cached(crop, node_caches[i], wanted)
+
+        print "Parsing changes"
+        return OSMChange.from_elements(iterparse_elements(source), refs)
+
+    @staticmethod
+    def referenced_nodes(source):
+        """Ids of every node referenced by a way or relation in source"""
+        wanted = set()
+        for change_t, element in iterparse_elements(source):
+            for e in element:
+                if e.tag == "nd":
+                    wanted.add(e.attrib['ref'])
+                elif e.tag == "member" and e.attrib['type'] == "node":
+                    wanted.add(e.attrib['ref'])
+        return wanted
+
+    @staticmethod
+    def from_elements(elements, refs):
+        create = []
+        modify = []
+        delete = []
+
+        for change_t, element in elements:
+            if element.tag == BOUNDS:
+                continue
+            func = osm_func(
+                element.tag,
+                lambda: Node.from_xml(element),
+                lambda: Way.from_xml(element, refs),
+                lambda: Relation.from_xml(element, refs)
+            )
+            if func is not None:
+                value = func()
+                if value is not None:
+                    refs.put(value.osm_id, value)
+                    ctype = osc_func(change_t, create, modify, delete)
+                    if ctype is not None:
+                        ctype.append(value)
         return OSMChange(create, modify, delete)
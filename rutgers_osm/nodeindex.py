@@ -0,0 +1,140 @@
+import argparse
+import mmap
+import os
+import struct
+import subprocess
+import xml.etree.ElementTree as ET
+
+import rutgers_osm.osmosis as osmosis
+
+MAGIC = "NODEIDX1"
+HEADER = struct.Struct("<8sQ")
+
+# id, lon and lat in 1e-7 degrees, OSM's own precision
+RECORD = struct.Struct("<qii")
+SCALE = 10000000
+
+# Records buffered before they're written out while building
+BUILD_BATCH = 65536
+
+
+class NodeIndex(object):
+    """Location of every node in a full extract, from an index file of
+    fixed width records sorted by id. The file is memory mapped and
+    binary searched, so lookups take constant memory however big the
+    extract is.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("{0} isn't a node index".format(path))
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        return RECORD.unpack_from(self.map, HEADER.size + i * RECORD.size)
+
+    def get(self, osm_id):
+        """Returns (lon, lat) for osm_id or None"""
+        osm_id = int(osm_id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id, lon, lat = self.record(mid)
+            if mid_id < osm_id:
+                lo = mid + 1
+            elif mid_id > osm_id:
+                hi = mid
+            else:
+                return (float(lon) / SCALE, float(lat) / SCALE)
+        return None
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+
+def build(source, path):
+    """Write an index of the nodes in osm xml source, a file name or
+    object, to path. Nodes must come in id order, as they do in any
+    sorted extract. Returns the number of nodes indexed.
+    """
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    count = 0
+    last = None
+    batch = []
+    root = None
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0))
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event == "start":
+                continue
+            if elem.tag == "way" or elem.tag == "relation":
+                break
+            if elem.tag != "node":
+                continue
+            osm_id = int(elem.attrib['id'])
+            if last is not None and osm_id <= last:
+                os.remove(tmp)
+                raise ValueError("Nodes aren't sorted by id at {0}".format(osm_id))
+            last = osm_id
+            batch.append(RECORD.pack(osm_id,
+                                     int(round(float(elem.attrib['lon']) * SCALE)),
+                                     int(round(float(elem.attrib['lat']) * SCALE))))
+            if len(batch) >= BUILD_BATCH:
+                f.write(''.join(batch))
+                count += len(batch)
+                batch = []
+                # Drop the nodes parsed so far
+                root.clear()
+        f.write(''.join(batch))
+        count += len(batch)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, count))
+    os.rename(tmp, path)
+    return count
+
+
+def build_from_pbf(pbf, path):
+    """build() from a pbf extract, converted to xml by osmosis"""
+    cmd = osmosis.nodes(pbf)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        count = build(process.stdout, path)
+    except:
+        process.kill()
+        process.wait()
+        raise
+    process.stdout.close()
+    if process.wait() != 0:
+        os.remove(path)
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return count
+
+
+def build_node_index_main():
+    parser = argparse.ArgumentParser(
+        description='Index the node locations of a full extract')
+    parser.add_argument('extract', help='pbf, or osm xml with -x')
+    parser.add_argument('index', help='Index file to write')
+    parser.add_argument('-x', '--xml', action='store_true',
+                        help='The extract is osm xml, not pbf')
+    args = parser.parse_args()
+
+    if args.xml:
+        count = build(args.extract, args.index)
+    else:
+        count = build_from_pbf(args.extract, args.index)
+    print "Indexed {0} nodes".format(count)
+
+
+if __name__ == '__main__':
+    build_node_index_main()
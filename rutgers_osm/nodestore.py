@@ -0,0 +1,154 @@
+from array import array
+from bisect import bisect_left
+import hashlib
+import os
+import os.path
+
+# First line of a saved NodeStore, followed by its length and the size
+# of an id so a cache written on another platform isn't misread
+MAGIC = "NODESTORE1"
+
+CACHE_SUFFIX = ".nodes"
+
+HASH_CHUNK = 1024 * 1024
+
+
+def file_hash(path):
+    """sha1 of the contents of path"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, source):
+    """Where the nodes of osm file source are cached in cache_dir"""
+    return os.path.join(cache_dir, file_hash(source) + CACHE_SUFFIX)
+
+
+def prune_cache(cache_dir, keep):
+    """Remove every cached store in cache_dir but the paths in keep"""
+    keep = set(os.path.abspath(path) for path in keep)
+    for name in os.listdir(cache_dir):
+        path = os.path.abspath(os.path.join(cache_dir, name))
+        if name.endswith(CACHE_SUFFIX) and path not in keep:
+            os.remove(path)
+
+
+class NodeStore(object):
+    """Columnar store of node coordinates. Ids are kept sorted in an
+    int64 array with parallel float64 lon/lat arrays, which is a fraction
+    of the size of a dict of Node objects. Lookups are a binary search.
+    """
+
+    def __init__(self):
+        self.ids = array('l')
+        self.lons = array('d')
+        self.lats = array('d')
+        self.is_sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, osm_id):
+        return self.index(osm_id) is not None
+
+    def extend(self, other):
+        """Add every node of another NodeStore after the ones here"""
+        if other.ids and self.ids and other.ids[0] <= self.ids[-1]:
+            self.is_sorted = False
+        self.is_sorted = self.is_sorted and other.is_sorted
+        self.ids.extend(other.ids)
+        self.lons.extend(other.lons)
+        self.lats.extend(other.lats)
+
+    def subset(self, wanted):
+        """New NodeStore of only the ids in wanted, looked up one by one
+        so picking a few nodes out of a whole crop costs next to
+        nothing"""
+        self.sort()
+        store = NodeStore()
+        for osm_id in sorted(set(int(osm_id) for osm_id in wanted)):
+            i = bisect_left(self.ids, osm_id)
+            if i < len(self.ids) and self.ids[i] == osm_id:
+                store.add(osm_id, self.lons[i], self.lats[i])
+        return store
+
+    def add(self, osm_id, lon, lat):
+        osm_id = int(osm_id)
+        if self.ids and osm_id <= self.ids[-1]:
+            self.is_sorted = False
+        self.ids.append(osm_id)
+        self.lons.append(lon)
+        self.lats.append(lat)
+
+    def sort(self):
+        """Sort by id. When an id was added more than once the first
+        coordinates added win, like Refs.put_node.
+        """
+        if self.is_sorted:
+            return
+
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        ids = array('l')
+        lons = array('d')
+        lats = array('d')
+        for i in order:
+            if ids and ids[-1] == self.ids[i]:
+                continue
+            ids.append(self.ids[i])
+            lons.append(self.lons[i])
+            lats.append(self.lats[i])
+
+        self.ids = ids
+        self.lons = lons
+        self.lats = lats
+        self.is_sorted = True
+
+    def index(self, osm_id):
+        self.sort()
+        osm_id = int(osm_id)
+        i = bisect_left(self.ids, osm_id)
+        if i < len(self.ids) and self.ids[i] == osm_id:
+            return i
+        return None
+
+    def get(self, osm_id):
+        """Returns (lon, lat) for osm_id or None"""
+        i = self.index(osm_id)
+        if i is None:
+            return None
+        return (self.lons[i], self.lats[i])
+
+    def save(self, path):
+        """Write the sorted store to path as raw arrays, replacing it
+        atomically"""
+        self.sort()
+        tmp = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write("{0} {1} {2}\n".format(MAGIC, len(self.ids), self.ids.itemsize))
+            self.ids.tofile(f)
+            self.lons.tofile(f)
+            self.lats.tofile(f)
+        os.rename(tmp, path)
+
+    @staticmethod
+    def load(path):
+        """Read a store written by save(), None if path isn't a usable one"""
+        store = NodeStore()
+        try:
+            with open(path, 'rb') as f:
+                header = f.readline().split()
+                if len(header) != 3 or header[0] != MAGIC or int(header[2]) != store.ids.itemsize:
+                    return None
+                count = int(header[1])
+                store.ids.fromfile(f, count)
+                store.lons.fromfile(f, count)
+                store.lats.fromfile(f, count)
+        except (IOError, EOFError, ValueError):
+            return None
+        return store
@@ -1,3 +1,7 @@
+import subprocess
+import time
+
+
 def diff(file1, file2, output, format="pbf"):
     return [
         'osmosis',
@@ -43,3 +47,70 @@ def crop(file1, bbox, output):
         '--write-xml',
         'file={0}'.format(output)
     ]
+
+def nodes(file1, output='-'):
+    """Just the nodes of a pbf as xml, on stdout by default"""
+    return [
+        'osmosis',
+        '--read-pbf',
+        'file={0}'.format(file1),
+        '--tag-filter',
+        'reject-ways',
+        '--tag-filter',
+        'reject-relations',
+        '--write-xml',
+        'file={0}'.format(output)
+    ]
+
+
+class Stage(object):
+    """A command in a pipeline, run once every stage named in
+    depends has finished successfully.
+    """
+
+    def __init__(self, name, cmd, depends=None):
+        self.name = name
+        self.cmd = cmd
+        self.depends = depends or []
+
+
+def run_pipeline(stages, poll_interval=0.5):
+    """Run stages as soon as their dependencies are done, so independent
+    stages run concurrently. If a stage fails the others are killed and
+    CalledProcessError is raised. Returns the wall time of each stage.
+    """
+    waiting = list(stages)
+    running = {}
+    started = {}
+    times = {}
+
+    try:
+        while waiting or running:
+            for stage in list(waiting):
+                if all(dep in times for dep in stage.depends):
+                    print "Starting {0}".format(stage.name)
+                    started[stage.name] = time.time()
+                    running[stage.name] = (stage, subprocess.Popen(stage.cmd))
+                    waiting.remove(stage)
+
+            if not running:
+                raise ValueError("Unsatisfiable dependencies: {0}".format(
+                    ", ".join(stage.name for stage in waiting)))
+
+            time.sleep(poll_interval)
+
+            for name, (stage, proc) in running.items():
+                returncode = proc.poll()
+                if returncode is None:
+                    continue
+                del running[name]
+                if returncode != 0:
+                    raise subprocess.CalledProcessError(returncode, stage.cmd)
+                times[name] = time.time() - started[name]
+                print "Finished {0} in {1:.1f}s".format(name, times[name])
+    finally:
+        for stage, proc in running.values():
+            proc.kill()
+            proc.wait()
+
+    return times
@@ -0,0 +1,257 @@
+from math import pi,cos,sin,log,exp,atan
+
+from shapely.geometry import box
+from shapely.prepared import prep
+
+DEG_TO_RAD = pi/180
+RAD_TO_DEG = 180/pi
+
+
+def minmax (a,b,c):
+    a = max(a,b)
+    a = min(a,c)
+    return a
+
+class GoogleProjection:
+    def __init__(self,levels=18):
+        self.Bc = []
+        self.Cc = []
+        self.zc = []
+        self.Ac = []
+        c = 256
+        for d in range(0,levels):
+            e = c/2;
+            self.Bc.append(c/360.0)
+            self.Cc.append(c/(2 * pi))
+            self.zc.append((e,e))
+            self.Ac.append(c)
+            c *= 2
+                
+    def fromLLtoPixel(self,ll,zoom):
+         d = self.zc[zoom]
+         e = round(d[0] + ll[0] * self.Bc[zoom])
+         f = minmax(sin(DEG_TO_RAD * ll[1]),-0.9999,0.9999)
+         g = round(d[1] + 0.5*log((1+f)/(1-f))*-self.Cc[zoom])
+         return (e,g)
+     
+    def fromPixelToLL(self,px,zoom):
+         e = self.zc[zoom]
+         f = (px[0] - e[0])/self.Bc[zoom]
+         g = (px[1] - e[1])/-self.Cc[zoom]
+         h = RAD_TO_DEG * ( 2 * atan(exp(g)) - 0.5 * pi)
+         return (f,h)
+
+    def fromLLtoPixels(self, lls, zoom):
+        """fromLLtoPixel for a whole sequence of (lon, lat) at once.
+        The per-zoom constants are looked up once for the batch.
+        """
+        d0, d1 = self.zc[zoom]
+        b = self.Bc[zoom]
+        c = -0.5 * self.Cc[zoom]
+        pixels = []
+        for lon, lat in lls:
+            f = minmax(sin(DEG_TO_RAD * lat), -0.9999, 0.9999)
+            pixels.append((round(d0 + lon * b), round(d1 + log((1+f)/(1-f)) * c)))
+        return pixels
+
+    def fromPixelsToLL(self, pxs, zoom):
+        """fromPixelToLL for a whole sequence of pixels at once"""
+        e0, e1 = self.zc[zoom]
+        b = self.Bc[zoom]
+        c = -self.Cc[zoom]
+        return [((px - e0) / b, RAD_TO_DEG * (2 * atan(exp((py - e1) / c)) - 0.5 * pi))
+                for px, py in pxs]
+
+    def fromLLtoTiles(self, lls, zoom):
+        """Tile (x, y) containing each (lon, lat), clamped to the world"""
+        last = 2**zoom - 1
+        return [(minmax(int(px/256.0), 0, last), minmax(int(py/256.0), 0, last))
+                for px, py in self.fromLLtoPixels(lls, zoom)]
+
+    def tile_range(self, bbox, zoom):
+        """(xmin, ymin, xmax, ymax) of the tiles covering a
+        (minlon, minlat, maxlon, maxlat) bbox, inclusive
+        """
+        (x0, y0), (x1, y1) = self.fromLLtoTiles(
+            [(bbox[0], bbox[3]), (bbox[2], bbox[1])], zoom)
+        return (x0, y0, x1, y1)
+
+    def tile_row_bounds(self, y, x0, x1, zoom, size=1):
+        """(minlon, minlat, maxlon, maxlat) of every tile in row y from
+        x0 to x1 inclusive, or with size, of the size x size blocks of
+        tiles starting at row y and columns x0, x0 + size, ... up to x1.
+        The latitudes are shared by the whole row and the longitudes
+        evenly spaced, so only two points are ever projected.
+        """
+        (lon0, lat1), (lon1, lat0) = self.fromPixelsToLL(
+            [(x0 * 256, y * 256), ((x0 + size) * 256, (y + size) * 256)], zoom)
+        width = lon1 - lon0
+        return [(lon0 + i * width, lat0, lon0 + (i + 1) * width, lat1)
+                for i in xrange((x1 - x0) // size + 1)]
+
+
+# Enumeration orders for iter_tiles. xy walks columns of metatiles, the
+# others follow a space filling curve so consecutive tiles are close.
+ORDERS = ('xy', 'zorder', 'hilbert')
+
+# Quadrants (dx, dy, next state) of a tile in the order each curve visits
+# them, indexed by the orientation of the curve in the parent tile
+CURVES = {
+    'zorder': [
+        [(0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0)],
+    ],
+    'hilbert': [
+        [(0, 0, 1), (0, 1, 0), (1, 1, 0), (1, 0, 3)],
+        [(0, 0, 0), (1, 0, 1), (1, 1, 1), (0, 1, 2)],
+        [(1, 1, 3), (1, 0, 2), (0, 0, 2), (0, 1, 1)],
+        [(1, 1, 2), (0, 1, 3), (0, 0, 3), (1, 0, 0)],
+    ],
+}
+
+
+def curve_index(curve, z, x, y):
+    """Position of tile (x, y) along a curve from CURVES at zoom z"""
+    index = 0
+    state = 0
+    for level in range(z - 1, -1, -1):
+        quadrant = ((x >> level) & 1, (y >> level) & 1)
+        for i, (dx, dy, next_state) in enumerate(curve[state]):
+            if (dx, dy) == quadrant:
+                break
+        index = index * 4 + i
+        state = next_state
+    return index
+
+
+def tile_key(order='xy', metatile=1):
+    """Sort key for (z, x, y) tuples that visits tiles in the same order
+    as iter_tiles, keeping the tiles of each metatile together."""
+    if order not in ORDERS:
+        raise ValueError("Unknown order {0}".format(order))
+    if order == 'xy':
+        return lambda (z, x, y): (z, x // metatile, y // metatile, x, y)
+    if metatile & (metatile - 1):
+        raise ValueError("{0} order needs a power of two metatile".format(order))
+    curve = CURVES[order]
+    return lambda (z, x, y): (z, curve_index(curve, z, x, y))
+
+
+def iter_tiles(minZoom, maxZoom, bbox=None, shape=None, order='xy', metatile=1, proj=None):
+    """Lazily yield (z, x, y) for every tile from minZoom to maxZoom
+    inside bbox (minlon, minlat, maxlon, maxlat) and, if given,
+    touching shape, a shapely geometry in lon/lat. Tiles in the same
+    metatile are always yielded one after another.
+    """
+    if proj is None:
+        proj = GoogleProjection(maxZoom + 1)
+    bbox = clip_bbox(bbox, shape)
+    if bbox is None:
+        return
+    if shape is not None:
+        shape = prep(shape)
+
+    for z in range(minZoom, maxZoom + 1):
+        xmin, ymin, xmax, ymax = proj.tile_range(bbox, z)
+        for tile in iter_tile_range(z, xmin, ymin, xmax, ymax, shape, order, metatile, proj):
+            yield tile
+
+
+def clip_bbox(bbox=None, shape=None):
+    """bbox, the whole world if None, cut down to the bounds of shape.
+    None if they don't overlap."""
+    if bbox is None:
+        bbox = (-180.0, -90.0, 180.0, 90.0)
+    if shape is not None:
+        bounds = shape.bounds
+        bbox = (max(bbox[0], bounds[0]), max(bbox[1], bounds[1]),
+                min(bbox[2], bounds[2]), min(bbox[3], bounds[3]))
+        if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            return None
+    return bbox
+
+
+def work_units(minZoom, maxZoom, bbox=None, shape=None, metatile=1, proj=None):
+    """Split the tiles iter_tiles would yield into columns one metatile
+    wide. Yields (z, x0, x1, ymin, ymax), an inclusive range of tiles to
+    hand to iter_tile_range. (z, x0, x1) identifies the column.
+    """
+    if proj is None:
+        proj = GoogleProjection(maxZoom + 1)
+    bbox = clip_bbox(bbox, shape)
+    if bbox is None:
+        return
+
+    for z in range(minZoom, maxZoom + 1):
+        xmin, ymin, xmax, ymax = proj.tile_range(bbox, z)
+        for mx in range(xmin // metatile, xmax // metatile + 1):
+            yield (z, max(mx * metatile, xmin), min((mx + 1) * metatile - 1, xmax), ymin, ymax)
+
+
+def iter_tile_range(z, xmin, ymin, xmax, ymax, shape=None, order='xy', metatile=1, proj=None):
+    """iter_tiles for one zoom over an inclusive range of tile
+    co-ordinates. shape must already be prepared.
+    """
+    if order not in ORDERS:
+        raise ValueError("Unknown order {0}".format(order))
+    if proj is None:
+        proj = GoogleProjection(z + 1)
+
+    if order == 'xy':
+        tiles = _iter_xy(z, xmin, ymin, xmax, ymax, shape, metatile, proj)
+    else:
+        if metatile & (metatile - 1):
+            raise ValueError("{0} order needs a power of two metatile".format(order))
+        tiles = _iter_curve(CURVES[order], z, xmin, ymin, xmax, ymax, shape, proj, 0, 0, 0, 0)
+    for tile in tiles:
+        yield tile
+
+
+def touches(shape, proj, x0, y0, x1, y1, z):
+    """Whether shape touches the block of tiles x0..x1, y0..y1 at zoom z"""
+    minlon, minlat = proj.fromPixelToLL((x0 * 256, (y1 + 1) * 256), z)
+    maxlon, maxlat = proj.fromPixelToLL(((x1 + 1) * 256, y0 * 256), z)
+    return shape.intersects(box(minlon, minlat, maxlon, maxlat))
+
+
+def _iter_xy(z, xmin, ymin, xmax, ymax, shape, metatile, proj):
+    for mx in range(xmin // metatile, xmax // metatile + 1):
+        x0 = max(mx * metatile, xmin)
+        x1 = min((mx + 1) * metatile - 1, xmax)
+        for my in range(ymin // metatile, ymax // metatile + 1):
+            y0 = max(my * metatile, ymin)
+            y1 = min((my + 1) * metatile - 1, ymax)
+            if shape is not None and not touches(shape, proj, x0, y0, x1, y1, z):
+                continue
+            inside = None
+            if shape is not None and (x0 < x1 or y0 < y1):
+                # Tile bounds a row at a time, then yielded column by column
+                inside = set()
+                for y in range(y0, y1 + 1):
+                    for x, bounds in enumerate(proj.tile_row_bounds(y, x0, x1, z), x0):
+                        if shape.intersects(box(*bounds)):
+                            inside.add((x, y))
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    if inside is None or (x, y) in inside:
+                        yield (z, x, y)
+
+
+def _iter_curve(curve, z, xmin, ymin, xmax, ymax, shape, proj, level, x, y, state):
+    # Walk the quadtree down from (level, x, y), skipping any quadrant
+    # outside the range or the shape
+    shift = z - level
+    x0 = x << shift
+    y0 = y << shift
+    x1 = ((x + 1) << shift) - 1
+    y1 = ((y + 1) << shift) - 1
+    if x1 < xmin or x0 > xmax or y1 < ymin or y0 > ymax:
+        return
+    if shape is not None and not touches(shape, proj, x0, y0, x1, y1, z):
+        return
+    if level == z:
+        yield (z, x, y)
+        return
+    for dx, dy, next_state in curve[state]:
+        for tile in _iter_curve(curve, z, xmin, ymin, xmax, ymax, shape, proj,
+                                level + 1, 2 * x + dx, 2 * y + dy, next_state):
+            yield tile
@@ -0,0 +1,329 @@
+import errno
+import hashlib
+import os
+import os.path
+import sqlite3
+import stat
+import threading
+
+# Number of (z, x) column listings FileTileStore keeps around
+COLUMN_CACHE = 1024
+
+# Size in bytes of a rendered png256 tile with nothing on it
+EMPTY_TILE_SIZE = 103
+
+# Directory under tile_dir that DedupTileStore keeps tile contents in
+BLOB_DIR = ".blobs"
+
+# Tiles MBTilesStore buffers before writing them in one transaction
+MBTILES_BATCH = 500
+
+
+class TileStore(object):
+    """Where rendered tiles go. Keeps per zoom counters of what was
+    written so a run can report on it.
+    """
+
+    def __init__(self):
+        # Per zoom counters, see count()
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def count(self, z, **counters):
+        with self.stats_lock:
+            zoom = self.stats.setdefault(z, {})
+            for key, value in counters.iteritems():
+                zoom[key] = zoom.get(key, 0) + value
+
+    def merge_stats(self, stats):
+        """Add in the stats of another copy of this store, e.g. from a
+        worker process."""
+        for z, counters in stats.iteritems():
+            self.count(z, **counters)
+
+    def report(self):
+        lines = []
+        for z in sorted(self.stats):
+            counters = self.stats[z]
+            lines.append("zoom {0}: {1} tiles, {2} bytes".format(
+                z, counters.get('tiles', 0), counters.get('bytes', 0)))
+        return "\n".join(lines)
+
+    def flush(self):
+        """Make sure every tile written so far is stored, called before
+        work is recorded as done"""
+        pass
+
+    def close(self):
+        """Finish writing, called once rendering is done"""
+        pass
+
+
+class FileTileStore(TileStore):
+    """Tiles as loose pngs under tile_dir/z/x/y.png. Directories are
+    created once per (z, x) column and remembered afterwards, and
+    exists() lists a column once instead of stat-ing every tile.
+    """
+
+    def __init__(self, tile_dir, tms_scheme=False):
+        super(FileTileStore, self).__init__()
+        self.tile_dir = tile_dir
+        self.tms_scheme = tms_scheme
+        self.made = set()
+        self.columns = {}
+
+    def column(self, z, x):
+        return os.path.join(self.tile_dir, str(z), str(x))
+
+    def filename(self, z, y):
+        # flip y to match OSGEO TMS spec
+        if self.tms_scheme:
+            y = (2**z - 1) - y
+        return "%s.png" % y
+
+    def path(self, z, x, y):
+        return os.path.join(self.column(z, x), self.filename(z, y))
+
+    def makedirs(self, z, x):
+        if (z, x) in self.made:
+            return
+        try:
+            os.makedirs(self.column(z, x))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.made.add((z, x))
+
+    def exists(self, z, x, y):
+        names = self.columns.get((z, x))
+        if names is None:
+            if len(self.columns) >= COLUMN_CACHE:
+                self.columns.clear()
+            try:
+                names = set(os.listdir(self.column(z, x)))
+            except OSError:
+                names = set()
+            self.columns[(z, x)] = names
+        return self.filename(z, y) in names
+
+    def written(self, z, x, y):
+        """Note a new tile in its column's listing, if that's cached"""
+        names = self.columns.get((z, x))
+        if names is not None:
+            names.add(self.filename(z, y))
+
+    def write(self, z, x, y, data):
+        """Store an encoded tile, returns its size in bytes"""
+        self.makedirs(z, x)
+        # Write beside the tile and rename over it rather than writing in
+        # place, the path may be a hard link to a DedupTileStore blob
+        # that other tiles share
+        path = self.path(z, x, y)
+        tmp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        self.written(z, x, y)
+        self.count(z, tiles=1, bytes=len(data))
+        return len(data)
+
+
+class DedupTileStore(FileTileStore):
+    """FileTileStore that keeps every distinct tile once, named by its
+    sha1 under tile_dir/.blobs, and hard links tiles to it (or symlinks,
+    where a hard link isn't possible). Blank land, sea and empty tiles
+    all end up sharing a handful of files. A hard linked blob is removed
+    once re-rendering leaves no tile linked to it.
+    """
+
+    def __init__(self, tile_dir, tms_scheme=False):
+        super(DedupTileStore, self).__init__(tile_dir, tms_scheme)
+        self.blob_dir = os.path.join(tile_dir, BLOB_DIR)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest + ".png")
+
+    def write_blob(self, data):
+        """Store data under its hash, returns the blob path and whether
+        it was new"""
+        blob = self.blob_path(hashlib.sha1(data).hexdigest())
+        if os.path.isfile(blob):
+            return blob, False
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = "{0}.{1}.{2}.tmp".format(blob, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, blob)
+        return blob, True
+
+    def linked_blob(self, path):
+        """The blob the tile at path is hard linked to, if that's its
+        only other link"""
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if stat.S_ISLNK(st.st_mode) or st.st_nlink != 2:
+            return None
+        with open(path, 'rb') as f:
+            blob = self.blob_path(hashlib.sha1(f.read()).hexdigest())
+        try:
+            if os.stat(blob).st_ino == st.st_ino:
+                return blob
+        except OSError:
+            pass
+        return None
+
+    def release(self, blob):
+        """Remove blob if no tile links to it any more"""
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except OSError:
+            pass
+
+    def write(self, z, x, y, data):
+        blob, new = self.write_blob(data)
+        self.makedirs(z, x)
+
+        # Link next to the tile and rename over it so it's replaced atomically
+        path = self.path(z, x, y)
+        tmp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            os.link(blob, tmp)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # Released by another writer since write_blob looked
+                blob, new = self.write_blob(data)
+                os.link(blob, tmp)
+            else:
+                # Other filesystem or too many links, fall back to a symlink
+                os.symlink(os.path.abspath(blob), tmp)
+        old = self.linked_blob(path)
+        os.rename(tmp, path)
+        self.written(z, x, y)
+        if old is not None and old != blob:
+            self.release(old)
+
+        if new:
+            self.count(z, tiles=1, unique=1, bytes=len(data))
+        else:
+            self.count(z, tiles=1, saved=len(data))
+        return len(data)
+
+    def report(self):
+        lines = []
+        for z in sorted(self.stats):
+            counters = self.stats[z]
+            tiles = counters.get('tiles', 0)
+            unique = counters.get('unique', 0)
+            lines.append("zoom {0}: {1} tiles, {2} unique ({3:.1f}x), "
+                         "{4} bytes written, {5} bytes saved".format(
+                             z, tiles, unique, float(tiles) / max(unique, 1),
+                             counters.get('bytes', 0), counters.get('saved', 0)))
+        return "\n".join(lines)
+
+
+class MBTilesStore(TileStore):
+    """All tiles in a single MBTiles sqlite database at path, which can
+    be copied around or swapped into place in one go. Tiles are buffered
+    in memory and written MBTILES_BATCH at a time in a single short
+    transaction, so worker processes sharing the file only hold its
+    write lock while a batch goes in, never while rendering. Every
+    process opens its own connection on first use; threads share it
+    under a lock.
+
+    MBTiles rows are always numbered TMS style, tms_scheme is ignored.
+    """
+
+    def __init__(self, path, tms_scheme=False):
+        super(MBTilesStore, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+        # Rows written but not yet in the database, see flush()
+        self.rows = []
+        self.columns = {}
+
+    def connect(self):
+        if self.db is not None and self.pid == os.getpid():
+            return self.db
+        # Connections don't survive a fork, start afresh in a new process
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.text_factory = str
+        self.pid = os.getpid()
+        self.columns = {}
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, "
+                        "tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+                        "ON tiles (zoom_level, tile_column, tile_row)")
+        self.db.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?)", [
+            ('name', os.path.splitext(os.path.basename(self.path))[0]),
+            ('type', 'baselayer'),
+            ('version', '1.0'),
+            ('format', 'png'),
+        ])
+        self.db.commit()
+        return self.db
+
+    def row(self, z, y):
+        return (2**z - 1) - y
+
+    def exists(self, z, x, y):
+        with self.lock:
+            db = self.connect()
+            rows = self.columns.get((z, x))
+            if rows is None:
+                if len(self.columns) >= COLUMN_CACHE:
+                    self.columns.clear()
+                rows = set(row for row, in db.execute(
+                    "SELECT tile_row FROM tiles WHERE zoom_level = ? AND tile_column = ?",
+                    (z, x)))
+                self.columns[(z, x)] = rows
+            return self.row(z, y) in rows
+
+    def write(self, z, x, y, data):
+        with self.lock:
+            self.rows.append((z, x, self.row(z, y), sqlite3.Binary(data)))
+            rows = self.columns.get((z, x))
+            if rows is not None:
+                rows.add(self.row(z, y))
+            full = len(self.rows) >= MBTILES_BATCH
+        if full:
+            self.flush()
+        self.count(z, tiles=1, bytes=len(data))
+        return len(data)
+
+    def flush(self):
+        """Write the buffered tiles in one transaction"""
+        with self.lock:
+            if not self.rows:
+                return
+            db = self.connect()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.db is not None and self.pid == os.getpid():
+                self.db.close()
+            self.db = None
+
+
+# Tile stores selectable by name
+STORES = {
+    'file': FileTileStore,
+    'dedup': DedupTileStore,
+    'mbtiles': MBTilesStore,
+}
@@ -0,0 +1,176 @@
+import argparse
+import os
+import os.path
+import signal
+import sys
+import time
+
+from shapely.ops import unary_union
+
+from rutgers_osm import changeindex, dirty_tiles, get_rutgers
+from rutgers_osm.apply_changes import CHANGES, DTILES, LOCK, OSM2PGSQL, apply_change, pending_changes
+from rutgers_osm.generate_tiles import BACKENDS, METATILE, NUM_THREADS, RenderPool, metatile_jobs, report_metrics
+from rutgers_osm.tilestore import STORES
+
+# Seconds between looks at the changes directory when it's empty
+POLL_INTERVAL = 10
+
+
+class Stop(object):
+    """SIGINT/SIGTERM handler that stops the daemon, except while a
+    change is being applied. Stopping then would leave osm2pgsql
+    running without the lock, and the change file in place to be
+    applied a second time, so the stop waits until the change is done.
+    """
+
+    def __init__(self):
+        self.applying = False
+        self.requested = False
+
+    def __call__(self, signum, frame):
+        if not self.applying:
+            raise KeyboardInterrupt
+        if not self.requested:
+            print "Stopping once the current change is applied"
+            sys.stdout.flush()
+        self.requested = True
+
+
+def apply_and_queue(pool, change, command, dirty, minZoom, maxZoom, metatile, order, shape, index=None):
+    """Apply one change and queue the tiles it expired on pool. Queueing
+    blocks while the renderers are behind, which holds up the next
+    change until they catch up. Returns the number of tiles queued, or
+    None if the change couldn't be applied."""
+    changename = os.path.splitext(os.path.basename(change))[0]
+    expire_file = dirty + "-{0}".format(changename)
+    if not apply_change(command, change, expire_file):
+        return None
+    os.remove(change)
+    if index is not None:
+        index.applied(change)
+
+    tiles = dirty_tiles.dirty_set(dirty_tiles.read_tiles([expire_file]), minZoom, maxZoom)
+    tiles = dirty_tiles.prioritized(tiles, order, metatile, shape)
+    for z, block in metatile_jobs(tiles, metatile):
+        pool.put((changename, z, block))
+    pool.flush()
+    if os.path.isfile(expire_file):
+        os.remove(expire_file)
+    return len(tiles)
+
+
+def update_daemon(changes, mapfile, tile_dir, command=OSM2PGSQL, dirty=DTILES, minZoom=0, maxZoom=18, num_threads=NUM_THREADS, metatile=METATILE, backend='thread', store='file', order='xy', shape=None, poll_interval=POLL_INTERVAL, once=False, index=None):
+    """Apply change files as they appear in changes and re-render the
+    tiles each one expires, one change at a time. The render workers
+    and their stylesheets stay loaded between changes, and a change's
+    tiles start rendering while the next change is being applied.
+    With once, stop when changes is empty instead of waiting for more.
+    Applied changes are marked so in index, a ChangeIndex, if given.
+    """
+    store = STORES[store](tile_dir)
+    # Worker processes ignore SIGINT and SIGTERM, even when sent to the
+    # whole process group, so they can finish the queue while this one
+    # shuts down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    pool = RenderPool(store, mapfile, maxZoom, num_threads, overwrite=True, metatile=metatile, backend=backend)
+    stop = Stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    failed = set()
+    try:
+        while True:
+            todo = [change for change in pending_changes(changes) if change not in failed]
+            if not todo:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            for change in todo:
+                start = time.time()
+                stop.applying = True
+                try:
+                    queued = apply_and_queue(pool, change, command, dirty, minZoom, maxZoom, metatile, order, shape, index)
+                finally:
+                    stop.applying = False
+                if stop.requested:
+                    raise KeyboardInterrupt
+                if queued is None:
+                    # Leave it for apply-changes or a person to look at
+                    failed.add(change)
+                    continue
+                print "{0}: {1} tiles queued after {2:.1f}s".format(change, queued, time.time() - start)
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        print "Stopping, waiting for queued tiles to render"
+    finally:
+        pool.join()
+        store.close()
+        print store.report()
+        report_metrics(pool.metrics)
+
+
+def update_daemon_main():
+    parser = argparse.ArgumentParser(
+        description='Apply change files as they arrive and re-render the '
+                    'tiles they expire')
+    parser.add_argument('stylesheet', help='The maps stylesheet to use')
+    parser.add_argument('output_dir', help='The tiles directory')
+    parser.add_argument('-c', '--changes',
+                        default=CHANGES,
+                        help='Changes directory to watch')
+    parser.add_argument('-d', '--dirty-tiles',
+                        default=DTILES,
+                        help='Prefix for the expired tile lists')
+    parser.add_argument('-l', '--lock',
+                        default=LOCK,
+                        help='Lock file, shared with apply-changes')
+    parser.add_argument('-x', '--change-index',
+                        default=changeindex.CHANGE_INDEX,
+                        help='Database of the elements each change file touches')
+    parser.add_argument('-C', '--osm2pgsql',
+                        default=OSM2PGSQL,
+                        help='osm2pgsql command line, the expire file and '
+                             'change file are appended')
+    parser.add_argument('-i', '--poll-interval',
+                        default=POLL_INTERVAL, type=float,
+                        help='Seconds between checks for new changes')
+    parser.add_argument('-1', '--once',
+                        action='store_true',
+                        help='Exit once every pending change is done')
+    parser.add_argument('-z', '--min-zoom', default=0, type=int)
+    parser.add_argument('-Z', '--max-zoom', default=18, type=int)
+    parser.add_argument('-m', '--metatile', default=METATILE, type=int,
+                        help='Render tiles in blocks of N x N')
+    parser.add_argument('-n', '--num-threads', default=NUM_THREADS, type=int,
+                        help='Number of rendering workers')
+    parser.add_argument('-B', '--backend', default='thread', choices=BACKENDS,
+                        help='Render with threads or worker processes')
+    parser.add_argument('-s', '--store', default='file', choices=sorted(STORES),
+                        help='How to store rendered tiles')
+    args = parser.parse_args()
+
+    if os.path.isfile(args.lock):
+        print "Someone's already applying changes! Check {0}".format(args.lock)
+        sys.exit(1)
+
+    with open(args.lock, 'w+') as lock:
+        lock.write(str(os.getpid()))
+
+    index = None
+    try:
+        index = changeindex.ChangeIndex(args.change_index)
+        update_daemon(args.changes, args.stylesheet, args.output_dir,
+                      command=args.osm2pgsql, dirty=args.dirty_tiles,
+                      minZoom=args.min_zoom, maxZoom=args.max_zoom,
+                      num_threads=args.num_threads, metatile=args.metatile,
+                      backend=args.backend, store=args.store,
+                      shape=unary_union(get_rutgers()),
+                      poll_interval=args.poll_interval, once=args.once,
+                      index=index)
+    finally:
+        if index is not None:
+            index.close()
+        os.remove(args.lock)
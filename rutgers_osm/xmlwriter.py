@@ -0,0 +1,58 @@
+from xml.sax.saxutils import escape, quoteattr
+
+ATTR_ENTITIES = {'\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+
+def encode(value, encoding):
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    return str(value)
+
+
+class XMLWriter(object):
+    """Writes indented xml straight to a file handle one element at a
+    time, so documents never have to be built up as a tree first.
+    """
+
+    def __init__(self, f, indent="  ", encoding="utf-8"):
+        self.f = f
+        self.indent = indent
+        self.encoding = encoding
+        self.depth = 0
+        f.write("<?xml version='1.0' encoding='{0}'?>\n".format(encoding))
+
+    def _open_tag(self, tag, attrib, extra):
+        attrib = dict(attrib or {}, **extra)
+        parts = [tag]
+        for key in sorted(attrib):
+            parts.append('{0}={1}'.format(
+                encode(key, self.encoding),
+                quoteattr(encode(attrib[key], self.encoding), ATTR_ENTITIES)))
+        return self.indent * self.depth + '<' + ' '.join(parts)
+
+    def start(self, tag, attrib=None, **extra):
+        self.f.write(self._open_tag(tag, attrib, extra) + '>\n')
+        self.depth += 1
+
+    def end(self, tag):
+        self.depth -= 1
+        self.f.write(self.indent * self.depth + '</' + tag + '>\n')
+
+    def element(self, tag, attrib=None, text=None, **extra):
+        """Write an element with no children"""
+        if text:
+            self.f.write(self._open_tag(tag, attrib, extra) + '>' +
+                         escape(encode(text, self.encoding)) +
+                         '</' + tag + '>\n')
+        else:
+            self.f.write(self._open_tag(tag, attrib, extra) + '/>\n')
+
+    def write_element(self, elem):
+        """Write an ElementTree element and everything below it"""
+        if len(elem):
+            self.start(elem.tag, elem.attrib)
+            for child in elem:
+                self.write_element(child)
+            self.end(elem.tag)
+        else:
+            self.element(elem.tag, elem.attrib, elem.text and elem.text.strip())
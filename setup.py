@@ -7,10 +7,13 @@ setup(
     entry_points = {
         'console_scripts': [
             'apply-changes = rutgers_osm.apply_changes:apply_changes_main',
+            'build-node-index = rutgers_osm.nodeindex:build_node_index_main',
+            'commit-changes = rutgers_osm.commit_changes:commit_changes',
             'generate-changes = rutgers_osm.generate_changes:generate_changes_main',
             'generate-tiles = rutgers_osm.generate_tiles:generate_tiles_main',
             'generate-josm = rutgers_osm.generate_josm:generate_josm_main',
-            'get-new-jersey = rutgers_osm.get_new_jersey:get_new_jersey_main'
+            'get-new-jersey = rutgers_osm.get_new_jersey:get_new_jersey_main',
+            'update-daemon = rutgers_osm.update_daemon:update_daemon_main'
         ]
     }
 )
@@ -0,0 +1,116 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from StringIO import StringIO
+
+from rutgers_osm.apply_changes import merge_changes, pending_changes
+
+
+def node(id, version, lat='40.5', lon='-74.4'):
+    return "<node id='{0}' version='{1}' lat='{2}' lon='{3}'/>".format(id, version, lat, lon)
+
+
+def way(id, version, *refs):
+    nds = "".join("<nd ref='{0}'/>".format(ref) for ref in refs)
+    return "<way id='{0}' version='{1}'>{2}</way>".format(id, version, nds)
+
+
+def relation(id, version):
+    return "<relation id='{0}' version='{1}'><member type='way' ref='1' role=''/></relation>".format(id, version)
+
+
+class MergeChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def change(self, **sections):
+        self.files += 1
+        path = os.path.join(self.dir, "{0}.osc".format(self.files))
+        with open(path, 'w') as f:
+            f.write("<osmChange version='0.6'>")
+            for change_t in ('create', 'modify', 'delete'):
+                if change_t in sections:
+                    f.write("<{0}>{1}</{0}>".format(change_t, "".join(sections[change_t])))
+            f.write("</osmChange>")
+        return path
+
+    def merge(self, *changes):
+        f = StringIO()
+        merge_changes(changes, f)
+        root = ET.fromstring(f.getvalue())
+        self.assertEqual([section.tag for section in root], ['create', 'modify', 'delete'])
+        return dict((section.tag, [(e.tag, e.get('id'), e.get('version')) for e in section])
+                    for section in root)
+
+    def test_create_then_delete(self):
+        merged = self.merge(self.change(create=[node(1, 1), node(2, 1)]),
+                            self.change(delete=[node(1, 2)]))
+        self.assertEqual(merged, {'create': [('node', '2', '1')], 'modify': [], 'delete': []})
+
+    def test_delete_then_create(self):
+        merged = self.merge(self.change(delete=[node(1, 2)]),
+                            self.change(create=[node(1, 3)]))
+        self.assertEqual(merged, {'create': [], 'modify': [('node', '1', '3')], 'delete': []})
+
+    def test_modify_then_delete(self):
+        merged = self.merge(self.change(modify=[way(5, 2, 1, 2)]),
+                            self.change(delete=[way(5, 3)]))
+        self.assertEqual(merged['delete'], [('way', '5', '3')])
+        self.assertEqual(merged['modify'], [])
+
+    def test_newest_version_wins(self):
+        # File numbers get reused, so a later file can hold an older edit
+        merged = self.merge(self.change(modify=[node(1, 4, lat='41.0')]),
+                            self.change(modify=[node(1, 3, lat='40.0')]))
+        self.assertEqual(merged['modify'], [('node', '1', '4')])
+
+    def test_created_in_a_later_file(self):
+        # The create is the oldest edit even though it was read last
+        merged = self.merge(self.change(delete=[node(1, 2)]),
+                            self.change(create=[node(1, 1)]))
+        self.assertEqual(merged, {'create': [], 'modify': [], 'delete': []})
+
+    def test_element_order(self):
+        merged = self.merge(
+            self.change(create=[relation(7, 1), way(5, 1, 1, 2), node(1, 1)],
+                        delete=[node(2, 2), way(6, 2), relation(8, 2)]),
+            self.change(modify=[way(9, 2, 1), node(3, 2)]))
+        self.assertEqual([tag for tag, id, version in merged['create']], ['node', 'way', 'relation'])
+        self.assertEqual([tag for tag, id, version in merged['modify']], ['node', 'way'])
+        self.assertEqual([tag for tag, id, version in merged['delete']], ['relation', 'way', 'node'])
+
+    def test_keeps_element_content(self):
+        path = self.change(modify=["<way id='5' version='2'><nd ref='1'/><nd ref='2'/>"
+                                   "<tag k='highway' v='service'/></way>"])
+        f = StringIO()
+        merge_changes([path], f)
+        way = ET.fromstring(f.getvalue()).find('modify/way')
+        self.assertEqual([nd.get('ref') for nd in way.findall('nd')], ['1', '2'])
+        self.assertEqual(way.find('tag').get('v'), 'service')
+
+
+class PendingChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_numeric_order(self):
+        for name in ('10.osc', '9.osc', 'extra.osc', '2.osc', 'notes.txt'):
+            open(os.path.join(self.dir, name), 'w').close()
+        self.assertEqual([os.path.basename(path) for path in pending_changes(self.dir)],
+                         ['2.osc', '9.osc', '10.osc', 'extra.osc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from rutgers_osm import download
+
+BODY = "".join(chr(i % 256) for i in range(10000))
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves BODY with an ETag, honouring If-None-Match and Range with
+    If-Range the way Geofabrik does"""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers.items()))
+        body = self.server.body
+        if self.headers.getheader('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        byte_range = self.headers.getheader('Range')
+        if byte_range and self.headers.getheader('If-Range') == self.server.etag:
+            start = int(byte_range[len('bytes='):-1])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(body) - 1, len(body)))
+            self.send_header('Content-Length', str(len(body) - start))
+            self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            self.wfile.write(body[start:])
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.server.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.body = BODY
+        self.server.etag = ETAG
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/nj.osm.pbf'.format(self.server.server_port)
+        self.dir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.dir, 'nj.osm.pbf')
+        self.partial = download.PARTIAL.format(self.outfile)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write_partial(self, data, etag):
+        with open(self.partial, 'wb') as f:
+            f.write(data)
+        download.write_meta(self.partial, {'etag': etag, 'last_modified': None})
+
+    def test_download(self):
+        self.assertTrue(download.download(self.url, self.outfile, chunk_size=1000))
+        self.assertEqual(self.read(self.outfile), BODY)
+        self.assertEqual(download.read_meta(self.outfile)['etag'], ETAG)
+        self.assertFalse(os.path.exists(self.partial))
+
+    def test_not_modified(self):
+        download.download(self.url, self.outfile)
+        self.assertFalse(download.download(self.url, self.outfile))
+        self.assertEqual(self.server.requests[-1]['if-none-match'], ETAG)
+        self.assertEqual(self.read(self.outfile), BODY)
+
+    def test_resume(self):
+        self.write_partial(BODY[:4000], ETAG)
+        self.assertTrue(download.download(self.url, self.outfile))
+        self.assertEqual(self.read(self.outfile), BODY)
+        request = self.server.requests[-1]
+        self.assertEqual(request['range'], 'bytes=4000-')
+        self.assertEqual(request['if-range'], ETAG)
+
+    def test_resume_changed(self):
+        # If-Range doesn't match, the server sends the whole new file
+        self.write_partial("stale" * 100, '"v0"')
+        self.assertTrue(download.download(self.url, self.outfile))
+        self.assertEqual(self.read(self.outfile), BODY)
+        self.assertEqual(download.read_meta(self.outfile)['etag'], ETAG)
+
+    def test_partial_already_complete(self):
+        self.write_partial(BODY, ETAG)
+        self.assertTrue(download.download(self.url, self.outfile))
+        self.assertEqual(self.read(self.outfile), BODY)
+        # The 416 finished it, nothing was fetched again
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_incomplete(self):
+        self.server.body = BODY
+        original = Handler.do_GET
+
+        def truncated(handler):
+            handler.server.requests.append({})
+            handler.send_response(200)
+            handler.send_header('Content-Length', str(len(BODY)))
+            handler.send_header('ETag', ETAG)
+            handler.end_headers()
+            handler.wfile.write(BODY[:100])
+        Handler.do_GET = truncated
+        try:
+            self.assertRaises(IOError, download.fetch, self.url, self.outfile)
+        finally:
+            Handler.do_GET = original
+        # What arrived is kept to resume from
+        self.assertEqual(self.read(self.partial), BODY[:100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import fake_mapnik
+fake_mapnik.install()
+
+from rutgers_osm.generate_tiles import RenderThread, metatile_jobs, render_tiles
+from rutgers_osm.tiles import iter_tiles
+from rutgers_osm.tilestore import DedupTileStore, FileTileStore, MBTilesStore
+
+
+class MetatileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        del fake_mapnik.renders[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, *parts):
+        with open(os.path.join(self.dir, *parts)) as f:
+            return f.read()
+
+    def renderer(self, store, metatile=2):
+        return RenderThread(store, 'style.xml', None, 18, metatile=metatile)
+
+    def test_metatile_jobs(self):
+        tiles = [(15, 0, 0), (15, 0, 1), (15, 1, 0), (15, 2, 0), (16, 0, 0)]
+        self.assertEqual(list(metatile_jobs(tiles, 2)), [
+            (15, [(0, 0), (0, 1), (1, 0)]),
+            (15, [(2, 0)]),
+            (16, [(0, 0)]),
+        ])
+
+    def test_slicing(self):
+        store = FileTileStore(self.dir)
+        tiles = [(10, 20), (11, 20), (10, 21), (11, 21)]
+        sizes = self.renderer(store).render_metatile(tiles, 15)
+
+        self.assertEqual(fake_mapnik.renders, [(512, 512)])
+        self.assertEqual(self.read('15', '10', '20.png'), "0 0 256x256")
+        self.assertEqual(self.read('15', '11', '20.png'), "256 0 256x256")
+        self.assertEqual(self.read('15', '10', '21.png'), "0 256 256x256")
+        self.assertEqual(self.read('15', '11', '21.png'), "256 256 256x256")
+        self.assertEqual(sizes[(11, 21)], len("256 256 256x256"))
+        self.assertEqual(store.stats[15]['tiles'], 4)
+
+    def test_partial_metatile(self):
+        # Only the tiles asked for are rendered, not the whole block
+        store = FileTileStore(self.dir)
+        self.renderer(store).render_metatile([(11, 20), (11, 21)], 15)
+        self.assertEqual(fake_mapnik.renders, [(256, 512)])
+        self.assertEqual(self.read('15', '11', '21.png'), "0 256 256x256")
+        self.assertFalse(os.path.exists(os.path.join(self.dir, '15', '10')))
+
+    def test_single_tile(self):
+        store = FileTileStore(self.dir)
+        self.renderer(store, metatile=1).render_tile(3, 4, 5)
+        self.assertEqual(self.read('5', '3', '4.png'), "0 0 256x256")
+
+    def test_skip_existing(self):
+        store = FileTileStore(self.dir)
+        renderer = self.renderer(store)
+        renderer.render_job('test', 15, [(10, 20)])
+        renderer.render_job('test', 15, [(10, 20), (11, 20)])
+        self.assertEqual(fake_mapnik.renders, [(256, 256), (256, 256)])
+
+    def test_render_tiles(self):
+        bbox = (-74.5, 40.45, -74.4, 40.55)
+        render_tiles(bbox, 'style.xml', self.dir, 10, 13, num_threads=2, metatile=4)
+        expected = set(iter_tiles(10, 13, bbox))
+        written = set()
+        for root, dirs, files in os.walk(self.dir):
+            for name in files:
+                z, x = root.split(os.sep)[-2:]
+                written.add((int(z), int(x), int(name[:-len('.png')])))
+        self.assertEqual(written, expected)
+
+
+class TileStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tms_scheme(self):
+        store = FileTileStore(self.dir, tms_scheme=True)
+        store.write(2, 1, 0, "tile")
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, '2', '1', '3.png')))
+        self.assertTrue(FileTileStore(self.dir, tms_scheme=True).exists(2, 1, 0))
+
+    def test_dedup(self):
+        store = DedupTileStore(self.dir)
+        store.write(1, 0, 0, "same")
+        store.write(1, 0, 1, "same")
+        store.write(1, 1, 0, "other")
+        a = os.stat(store.path(1, 0, 0))
+        b = os.stat(store.path(1, 0, 1))
+        self.assertEqual(a.st_ino, b.st_ino)
+        self.assertEqual(store.stats[1], {'tiles': 3, 'unique': 2, 'bytes': 9, 'saved': 4})
+
+    def test_dedup_rerender(self):
+        store = DedupTileStore(self.dir)
+        store.write(1, 0, 0, "same")
+        store.write(1, 0, 1, "same")
+        store.write(1, 0, 0, "new")
+        # Replaced, not written through the shared blob
+        with open(store.path(1, 0, 1)) as f:
+            self.assertEqual(f.read(), "same")
+        store.write(1, 0, 1, "new")
+        blobs = [name for root, dirs, files in os.walk(store.blob_dir) for name in files]
+        self.assertEqual(len(blobs), 1)
+
+    def test_file_store_over_dedup(self):
+        DedupTileStore(self.dir).write(1, 0, 0, "same")
+        DedupTileStore(self.dir).write(1, 0, 1, "same")
+        FileTileStore(self.dir).write(1, 0, 0, "new")
+        with open(os.path.join(self.dir, '1', '0', '1.png')) as f:
+            self.assertEqual(f.read(), "same")
+
+    def test_mbtiles(self):
+        path = os.path.join(self.dir, 'tiles.mbtiles')
+        store = MBTilesStore(path)
+        self.assertFalse(store.exists(2, 1, 0))
+        store.write(2, 1, 0, "tile")
+        # Still buffered, but already there as far as rendering goes
+        self.assertTrue(store.exists(2, 1, 0))
+        store.write(2, 1, 0, "again")
+        store.close()
+
+        db = sqlite3.connect(path)
+        rows = [(z, x, y, str(data)) for z, x, y, data in
+                db.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")]
+        self.assertEqual(rows, [(2, 1, 3, "again")])
+        self.assertEqual(dict(db.execute("SELECT name, value FROM metadata"))['format'], 'png')
+        db.close()
+        self.assertTrue(MBTilesStore(path).exists(2, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import os.path
+import shutil
+import signal
+import stat
+import tempfile
+import unittest
+
+import fake_mapnik
+fake_mapnik.install()
+
+from rutgers_osm import changeindex
+from rutgers_osm.update_daemon import update_daemon
+
+# Stands in for osm2pgsql: takes "-o expire_file change", expires one
+# tile, and fails on any change with "bad" in its name
+OSM2PGSQL = """#!/bin/sh
+case "$3" in
+    *bad*) exit 1 ;;
+esac
+echo 15/9611/12340 > "$2"
+"""
+
+CHANGE = """<osmChange version='0.6'>
+<modify><node id='1' version='2' lat='40.5' lon='-74.4'/></modify>
+</osmChange>
+"""
+
+
+class UpdateDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.changes = os.path.join(self.dir, 'changes')
+        self.tiles = os.path.join(self.dir, 'tiles')
+        self.dirty = os.path.join(self.dir, 'dirty-tiles')
+        os.mkdir(self.changes)
+        self.command = os.path.join(self.dir, 'osm2pgsql')
+        with open(self.command, 'w') as f:
+            f.write(OSM2PGSQL)
+        os.chmod(self.command, stat.S_IRWXU)
+        self.index = changeindex.ChangeIndex(os.path.join(self.dir, 'changes.sqlite'))
+        # update_daemon installs its own handlers
+        self.handlers = [(signum, signal.getsignal(signum))
+                         for signum in (signal.SIGINT, signal.SIGTERM)]
+
+    def tearDown(self):
+        for signum, handler in self.handlers:
+            signal.signal(signum, handler)
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def change(self, name):
+        path = os.path.join(self.changes, name)
+        with open(path, 'w') as f:
+            f.write(CHANGE)
+        self.index.add(path, changeindex.CHANGES)
+        return path
+
+    def run_daemon(self):
+        update_daemon(self.changes, 'style.xml', self.tiles, command=self.command,
+                      dirty=self.dirty, minZoom=15, maxZoom=15, num_threads=2,
+                      once=True, index=self.index)
+
+    def test_once(self):
+        good = self.change('1.osc')
+        bad = self.change('2-bad.osc')
+        self.run_daemon()
+
+        self.assertFalse(os.path.exists(good))
+        self.assertIsNone(self.index.file_id(good))
+        self.assertIsNotNone(self.index.file_id(good, states=(changeindex.APPLIED,)))
+        with open(os.path.join(self.tiles, '15', '9611', '12340.png')) as f:
+            self.assertEqual(f.read(), "0 0 256x256")
+        self.assertFalse(os.path.exists(self.dirty + '-1'))
+
+        # A change that failed to apply is left for someone to look at
+        self.assertTrue(os.path.exists(bad))
+        self.assertIsNotNone(self.index.file_id(bad))
+
+    def test_nothing_to_do(self):
+        self.run_daemon()
+        self.assertFalse(os.path.exists(self.tiles))
+
+
+if __name__ == '__main__':
+    unittest.main()